@@ -10,6 +10,7 @@ See <http://www.opensource.org/licenses/lgpl-3.0.html> for license details.
 
 #include "VX_SimGA.h"
 #include <iostream>
+#include <fstream>
 #include <cmath>
 
 CVX_SimGA::CVX_SimGA()
@@ -17,6 +18,7 @@ CVX_SimGA::CVX_SimGA()
 	Fitness = 0.0f;
 	TrackVoxel = 0;
 	FitnessFileName = "";
+	TraceFileName = "";
 //	print_scrn = false;
 	WriteFitnessFile = false;
 	FitnessType = FT_NONE;	//no reporting is default
@@ -25,11 +27,26 @@ CVX_SimGA::CVX_SimGA()
 
 void CVX_SimGA::SaveResultFile(std::string filename)
 {
+	// the trace must be complete before the fitness file appears, since the latter signals the end of the evaluation
+	if (TraceFileName != "" && pEnv->getTimeBetweenTraces() > 0 && pEnv->getUsingSaveTraces())
+		SaveTraceFile(TraceFileName);
+
 	CXML_Rip XML;
 	WriteResultFile(&XML);
 	XML.SaveFile(filename);
 }
 
+void CVX_SimGA::SaveTraceFile(std::string filename)
+{
+	// one packed record of four float32 (x, y, z, time) per trace step, memory-mapped by the python reader
+	std::ofstream ofs(filename.c_str(), std::ofstream::out | std::ofstream::binary);
+	for(std::vector<vfloat>::size_type i = 0; i != SS.CMTraceTime.size(); ++i)
+	{
+		float record[4] = {(float)SS.CMTrace[i].x, (float)SS.CMTrace[i].y, (float)SS.CMTrace[i].z, (float)SS.CMTraceTime[i]};
+		ofs.write(reinterpret_cast<const char*>(record), sizeof(record));
+	}
+	ofs.close();
+}
 
 void CVX_SimGA::WriteResultFile(CXML_Rip* pXML)
 {
@@ -236,6 +253,7 @@ void CVX_SimGA::WriteAdditionalSimXML(CXML_Rip* pXML)
 		pXML->Element("FitnessType", (int)FitnessType);
 		pXML->Element("TrackVoxel", TrackVoxel);
 		pXML->Element("FitnessFileName", FitnessFileName);
+		pXML->Element("TraceFileName", TraceFileName);
 		pXML->Element("WriteFitnessFile", WriteFitnessFile);
 	pXML->UpLevel();
 }
@@ -248,6 +266,7 @@ bool CVX_SimGA::ReadAdditionalSimXML(CXML_Rip* pXML, std::string* RetMessage)
 		if (pXML->FindLoadElement("FitnessType", &TmpInt)) FitnessType=(FitnessTypes)TmpInt; else Fitness = 0;
 		if (!pXML->FindLoadElement("TrackVoxel", &TrackVoxel)) TrackVoxel = 0;
 		if (!pXML->FindLoadElement("FitnessFileName", &FitnessFileName)) FitnessFileName = "";
+		if (!pXML->FindLoadElement("TraceFileName", &TraceFileName)) TraceFileName = "";
 		if (!pXML->FindLoadElement("QhullTmpFile", &QhullTmpFile)) QhullTmpFile = "";		
 		if (!pXML->FindLoadElement("CurvaturesTmpFile", &CurvaturesTmpFile)) CurvaturesTmpFile = "";		
 		if (!pXML->FindLoadElement("WriteFitnessFile", &WriteFitnessFile)) WriteFitnessFile = true;
@@ -25,6 +25,7 @@ public:
 	~CVX_SimGA(){};
 
 	void SaveResultFile(std::string filename);
+	void SaveTraceFile(std::string filename);
 	void WriteResultFile(CXML_Rip* pXML);
 
 	void WriteAdditionalSimXML(CXML_Rip* pXML);
@@ -34,6 +35,7 @@ public:
 	FitnessTypes FitnessType; //!<Holds the fitness reporting type. For now =0 tracks the center of mass, =1 tracks a particular Voxel number
 	int	TrackVoxel;		//!<Holds the particular voxel that will be tracked (if used).
 	std::string FitnessFileName;	//!<Holds the filename of the fitness output file that might be used
+	std::string TraceFileName;	//!<Holds the filename of the binary center of mass trace file that might be used
 	bool WriteFitnessFile;
 //	bool print_scrn;	//!<flags whether status will be sent to the console
 
@@ -4,10 +4,101 @@ import networkx as nx
 from networkx import DiGraph
 from copy import deepcopy
 from collections import OrderedDict
+from itertools import chain
 
 from evosoro.tools.utils import neg_abs, neg_square, sqrt_abs, neg_sqrt_abs, normalize, sigmoid
 
 
+def _neg_abs_in_place(x, out):
+    return np.negative(np.abs(x, out=out), out=out)
+
+
+def _neg_square_in_place(x, out):
+    return np.negative(np.square(x, out=out), out=out)
+
+
+def _sqrt_abs_in_place(x, out):
+    return np.sqrt(np.abs(x, out=out), out=out)
+
+
+def _neg_sqrt_abs_in_place(x, out):
+    return np.negative(_sqrt_abs_in_place(x, out), out=out)
+
+
+def _sigmoid_in_place(x, out):
+    np.negative(x, out=out)
+    np.exp(out, out=out)
+    np.add(1.0, out, out=out)
+    np.divide(2.0, out, out=out)
+    return np.subtract(out, 1.0, out=out)
+
+
+# in-place versions of the activation functions, performing the very same floating point operations
+IN_PLACE_FUNCTIONS = {np.sin: lambda x, out: np.sin(x, out=out),
+                      np.abs: lambda x, out: np.abs(x, out=out),
+                      neg_abs: _neg_abs_in_place,
+                      np.square: lambda x, out: np.square(x, out=out),
+                      neg_square: _neg_square_in_place,
+                      sqrt_abs: _sqrt_abs_in_place,
+                      neg_sqrt_abs: _neg_sqrt_abs_in_place,
+                      sigmoid: _sigmoid_in_place}
+
+
+INPUT_GRIDS = {}  # (orig_size_xyz, dtype) -> {input node name: state}, shared by all the CPPNs of this size
+
+
+def get_input_grids(orig_size_xyz, dtype=np.float64):
+    """Return the read-only CPPN input states for a lattice size, computing them on first use.
+
+    Parameters
+    ----------
+    orig_size_xyz : 3-tuple (x, y, z)
+        The size of the lattice.
+
+    dtype : numpy float type
+        The type of the states.
+
+    Returns
+    -------
+    input_grids : dict
+        The state of each input node ('x', 'y', 'z', 'd', 'b'), shared by reference: never modify them.
+
+    """
+    key = (tuple(orig_size_xyz), np.dtype(dtype))
+    if key not in INPUT_GRIDS:
+        input_x, input_y, input_z = np.meshgrid(*[np.arange(n, dtype=dtype) for n in orig_size_xyz], indexing="ij")
+
+        input_x = normalize(input_x)
+        input_y = normalize(input_y)
+        input_z = normalize(input_z)
+        input_d = normalize(np.power(np.power(input_x, 2) + np.power(input_y, 2) + np.power(input_z, 2), 0.5))
+        # TODO: check input_d (above): changed pow -> np.power without testing
+        input_b = np.ones(orig_size_xyz, dtype=dtype)
+
+        input_grids = {"x": input_x, "y": input_y, "z": input_z, "d": input_d, "b": input_b}
+        for state in input_grids.values():
+            state.flags.writeable = False
+        INPUT_GRIDS[key] = input_grids
+    return INPUT_GRIDS[key]
+
+
+def _reachable_nodes(names, next_nodes):
+    """Return the set of nodes reachable from names (included), next_nodes mapping a node to the nodes it leads to."""
+    reachable = set(names)
+    to_visit = list(reachable)
+    while len(to_visit) > 0:
+        for node in next_nodes.get(to_visit.pop(), []):
+            if node not in reachable:
+                reachable.add(node)
+                to_visit += [node]
+    return reachable
+
+
+def _detached(state):
+    """Return state, copied if it is a view of a larger array (e.g. the buffers of a CompiledCPPN)."""
+    return state if state.base is None else state.copy()
+
+
 class OrderedGraph(DiGraph):
     """Create a graph object that tracks the order nodes and their neighbors are added."""
     node_dict_factory = OrderedDict
@@ -34,6 +125,10 @@ class Network(object):
         new.__dict__.update(deepcopy(self.__dict__, memo))
         return new
 
+    def get_output_state(self, name):
+        """Return the state of an output node computed by the last expression."""
+        return self.graph.node[name]["state"]
+
     def set_input_node_states(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -49,6 +144,8 @@ class CPPN(Network):
 
     def __init__(self, output_node_names):
         Network.__init__(self, output_node_names)
+        self.compiled = None  # CompiledCPPN, dropped whenever the topology changes
+        self.edge_candidates = None  # edges which add_link may create, see get_edge_candidates
         self.set_minimal_graph()
         self.mutate()
 
@@ -66,40 +163,93 @@ class CPPN(Network):
                     if self.graph.node[output_node]["type"] == "output":
                         self.graph.add_edge(input_node, output_node, weight=0.0)
 
-    def set_input_node_states(self, orig_size_xyz):
-        input_x = np.zeros(orig_size_xyz)
-        input_y = np.zeros(orig_size_xyz)
-        input_z = np.zeros(orig_size_xyz)
-        for x in range(orig_size_xyz[0]):
-            for y in range(orig_size_xyz[1]):
-                for z in range(orig_size_xyz[2]):
-                    input_x[x, y, z] = x
-                    input_y[x, y, z] = y
-                    input_z[x, y, z] = z
+    def __deepcopy__(self, memo):
+        """Share the input states, which are read-only and cached per lattice size, instead of copying them.
 
-        input_x = normalize(input_x)
-        input_y = normalize(input_y)
-        input_z = normalize(input_z)
-        input_d = normalize(np.power(np.power(input_x, 2) + np.power(input_y, 2) + np.power(input_z, 2), 0.5))
-        input_b = np.ones(orig_size_xyz)  # TODO: check input_d (above): changed pow -> np.power without testing
+        The node states cached by the compiled network are shared as well (see CompiledCPPN.__deepcopy__), and so is
+        the list of edge candidates, which is replaced rather than modified (see get_edge_candidates).
+
+        """
+        for name in self.input_node_names:
+            if self.graph.has_node(name) and "state" in self.graph.node[name]:
+                memo[id(self.graph.node[name]["state"])] = self.graph.node[name]["state"]
+        if self.compiled is not None:
+            self.compiled.share_states(memo)
+        if self.edge_candidates is not None:
+            memo[id(self.edge_candidates)] = self.edge_candidates
+        return Network.__deepcopy__(self, memo)
+
+    def __getstate__(self):
+        """Leave the input states and the edge candidates out of checkpoints, they are rebuilt when needed."""
+        state = self.__dict__.copy()
+        state["edge_candidates"] = None
+        graph = self.graph.__class__.__new__(self.graph.__class__)
+        graph.__dict__.update(self.graph.__dict__)
+        graph.node = graph.node_dict_factory(self.graph.node)
+        for name in self.input_node_names:
+            if graph.has_node(name):
+                graph.node[name] = dict((key, value) for key, value in graph.node[name].items() if key != "state")
+        state["graph"] = graph
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in ["compiled", "edge_candidates"]:  # caches missing from older checkpoints
+            self.__dict__.setdefault(name, None)
+        if getattr(self, "input_size_xyz", None) is not None:
+            self.set_input_node_states(self.input_size_xyz, getattr(self, "input_dtype", np.float64))
+
+    def set_input_node_states(self, orig_size_xyz, dtype=np.float64):
+        input_grids = get_input_grids(orig_size_xyz, dtype)
+        self.input_size_xyz = tuple(orig_size_xyz)
+        self.input_dtype = dtype
 
         for name in self.graph.nodes():
-            if name == "x":
-                self.graph.node[name]["state"] = input_x
-                self.graph.node[name]["evaluated"] = True
-            if name == "y":
-                self.graph.node[name]["state"] = input_y
-                self.graph.node[name]["evaluated"] = True
-            if name == "z":
-                self.graph.node[name]["state"] = input_z
-                self.graph.node[name]["evaluated"] = True
-            if name == "d":
-                self.graph.node[name]["state"] = input_d
-                self.graph.node[name]["evaluated"] = True
-            if name == "b":
-                self.graph.node[name]["state"] = input_b
+            if name in input_grids:
+                self.graph.node[name]["state"] = input_grids[name]
                 self.graph.node[name]["evaluated"] = True
 
+    def calc_output_states(self, orig_size_xyz, to_phenotype_mapping, dtype=np.float64, chunk_size=None):
+        """Propagate the input states through the network, storing the new state of each node in the graph.
+
+        If chunk_size is given, the outputs are evaluated by slabs of chunk_size z layers and only their states are
+        stored (see CompiledCPPN.run_chunked).
+
+        """
+        if self.compiled is None:
+            self.compiled = CompiledCPPN(self, to_phenotype_mapping)
+        if chunk_size is None:
+            self.compiled.run(self, orig_size_xyz, dtype)
+        else:
+            self.compiled.run_chunked(self, orig_size_xyz, dtype, chunk_size)
+
+    def store_states(self, node_states, output_states):
+        """Store the states computed by a CompiledCPPN: the state of each node, then the final output states."""
+        for name, state in node_states:
+            self.graph.node[name]["state"] = state
+        for name, state in output_states:
+            self.graph.node[name]["state"] = state
+
+    def reset_old_states(self):
+        """Clear the old state of the output nodes, once a mutation of the network has been accepted."""
+        for output_node in self.output_node_names:
+            self.graph.node[output_node]["old_state"] = ""
+
+    def release_states(self):
+        """Drop the states of the hidden nodes and the states cached by the compiled network, keep the output states.
+
+        The output states are copied out of the compiled buffers so that they don't keep them alive. The next expression
+        computes all the nodes again.
+
+        """
+        for name in self.graph.nodes():
+            if name not in self.input_node_names and name not in self.output_node_names:
+                self.graph.node[name].pop("state", None)
+        for name in self.output_node_names:
+            self.graph.node[name]["state"] = _detached(self.graph.node[name]["state"])
+        if self.compiled is not None:
+            self.compiled.release()
+
     def mutate(self, num_random_node_adds=5, num_random_node_removals=0, num_random_link_adds=10,
                num_random_link_removals=5, num_random_activation_functions=100, num_random_weight_changes=100):
 
@@ -148,6 +298,8 @@ class CPPN(Network):
         this_edge = random.choice(self.graph.edges())
         node1 = this_edge[0]
         node2 = this_edge[1]
+        self.compiled = None
+        self.edge_candidates = None
 
         # create a new node hanging from the previous output node
         new_node_index = self.get_max_hidden_node_index()
@@ -172,6 +324,8 @@ class CPPN(Network):
         if len(hidden_nodes) == 0:
             return "NoHiddenNodes"
         this_node = random.choice(hidden_nodes)
+        self.compiled = None
+        self.edge_candidates = None
 
         # if there are edge paths going through this node, keep them connected to minimize disruption
         incoming_edges = self.graph.in_edges(nbunch=[this_node])
@@ -187,34 +341,25 @@ class CPPN(Network):
         return ""
 
     def add_link(self):
-        done = False
-        attempt = 0
-        while not done:
-            done = True
-
-            # choose two random nodes (between which a link could exist, *but doesn't*)
-            node1 = random.choice(self.graph.nodes())
-            node2 = random.choice(self.graph.nodes())
-            while (not self.new_edge_is_valid(node1, node2)) and attempt < 999:
-                node1 = random.choice(self.graph.nodes())
-                node2 = random.choice(self.graph.nodes())
-                attempt += 1
-            if attempt > 999:  # no valid edges to add found in 1000 attempts
-                done = True
-
-            # create a link between them
-            if random.random() > 0.5:
-                self.graph.add_edge(node1, node2, weight=0.1)
-            else:
-                self.graph.add_edge(node1, node2, weight=-0.1)
-
-            # If the link creates a cyclic graph, erase it and try again
-            if self.has_cycles():
-                self.graph.remove_edge(node1, node2)
-                done = False
-                attempt += 1
-            if attempt > 999:
-                done = True
+        # choose two random nodes between which a link could exist, *but doesn't*: see get_edge_candidates
+        edge_candidates = self.get_edge_candidates()
+        if len(edge_candidates) == 0:
+            return "NoValidEdges"
+        node1, node2 = random.choice(edge_candidates)
+
+        # create a link between them
+        if random.random() > 0.5:
+            self.graph.add_edge(node1, node2, weight=0.1)
+        else:
+            self.graph.add_edge(node1, node2, weight=-0.1)
+        self.compiled = None
+
+        # the new link rules out itself and any link from node2 or its descendants to node1 or its ancestors
+        downstream = nx.descendants(self.graph, node2) | set([node2])
+        upstream = nx.ancestors(self.graph, node1) | set([node1])
+        self.edge_candidates = [(source, target) for source, target in edge_candidates
+                                if not (source in downstream and target in upstream) and
+                                (source, target) != (node1, node2)]
         return ""
 
     def remove_link(self):
@@ -222,6 +367,8 @@ class CPPN(Network):
             return "NoEdges"
         this_link = random.choice(self.graph.edges())
         self.graph.remove_edge(this_link[0], this_link[1])
+        self.compiled = None
+        self.edge_candidates = None
         return ""
 
     def mutate_function(self):
@@ -231,6 +378,8 @@ class CPPN(Network):
         old_function = self.graph.node[this_node]["function"]
         while self.graph.node[this_node]["function"] == old_function:
             self.graph.node[this_node]["function"] = random.choice(self.activation_functions)
+        if self.compiled is not None:
+            self.compiled.set_function(this_node, self.graph.node[this_node]["function"])
         return old_function.__name__ + "-to-" + self.graph.node[this_node]["function"].__name__
 
     def mutate_weight(self, mutation_std=0.5):
@@ -245,6 +394,8 @@ class CPPN(Network):
             new_weight = random.gauss(old_weight, mutation_std)
             new_weight = max(-1.0, min(new_weight, 1.0))
         self.graph[node1][node2]["weight"] = new_weight
+        if self.compiled is not None:
+            self.compiled.set_weight(node1, node2, new_weight)
         return float(new_weight - old_weight)
 
     ###############################################
@@ -252,31 +403,38 @@ class CPPN(Network):
     ###############################################
 
     def prune_network(self):
-        """Remove erroneous nodes and edges post mutation."""
-        done = False
-        while not done:
-            done = True
-            for node in self.graph.nodes():
-                if len(self.graph.in_edges(nbunch=[node])) == 0 and \
-                                node not in self.input_node_names and \
-                                node not in self.output_node_names:
-                    self.graph.remove_node(node)
-                    done = False
-
-            for node in self.graph.nodes():
-                if len(self.graph.out_edges(nbunch=[node])) == 0 and \
-                                node not in self.input_node_names and \
-                                node not in self.output_node_names:
-                    self.graph.remove_node(node)
-                    done = False
-
-    def has_cycles(self):
-        """Return True if the graph contains simple cycles (elementary circuits).
-
-        A simple cycle is a closed path where no node appears twice, except that the first and last node are the same.
+        """Remove erroneous nodes and edges post mutation.
+
+        The hidden nodes kept are those on a path between input or output nodes: the others are removed in one batch,
+        with their edges. This is the fixed point of repeatedly removing the hidden nodes without incoming edges or
+        without outgoing edges.
+
+        """
+        anchors = self.input_node_names + self.output_node_names
+        connected = _reachable_nodes(anchors, self.graph.succ) & _reachable_nodes(anchors, self.graph.pred)
+        dangling = [node for node in self.graph.nodes() if node not in connected]
+        if len(dangling) > 0:
+            self.graph.remove_nodes_from(dangling)
+            self.compiled = None
+            self.edge_candidates = None
+
+    def get_edge_candidates(self):
+        """Return the edges which can be added to the graph, in node order, building the list if needed.
+
+        An edge is a candidate if new_edge_is_valid and if it keeps the graph acyclic, that is if its source is not
+        reachable from its target. The list is kept up to date by add_link and rebuilt after other topology changes. It
+        is never modified in place, so that the copies of the network can share it.
 
         """
-        return sum(1 for _ in nx.simple_cycles(self.graph)) != 0
+        if self.edge_candidates is None:
+            nodes = self.graph.nodes()
+            ancestors = dict((node, set()) for node in nodes)
+            for node in nx.topological_sort(self.graph):
+                for predecessor in self.graph.pred[node]:
+                    ancestors[node] |= ancestors[predecessor] | set([predecessor])
+            self.edge_candidates = [(node1, node2) for node1 in nodes for node2 in nodes
+                                    if self.new_edge_is_valid(node1, node2) and node2 not in ancestors[node1]]
+        return self.edge_candidates
 
     def get_max_hidden_node_index(self):
         max_index = 0
@@ -292,13 +450,797 @@ class CPPN(Network):
             return False
         if self.graph.node[node2]['type'] == "input":
             return False
-        if (node2, node1) in nx.edges(self.graph):
+        if self.graph.has_edge(node2, node1):
             return False
-        if (node1, node2) in nx.edges(self.graph):
+        if self.graph.has_edge(node1, node2):
             return False
         return True
 
 
+class CompactCPPN(object):
+    """A CPPN stored in parallel lists of nodes and edges, with neither networkx graph nor per node states.
+
+    It has the interface and the mutation operators of CPPN, but is much cheaper to copy and pickle. Only the output
+    states of the last expression are kept. The graph property builds an equivalent networkx graph on demand (e.g. for
+    write_networks): it is read-only, changes made to it are not reflected in the network.
+
+    """
+
+    __slots__ = ["output_node_names", "freeze", "allow_neutral_mutations", "num_consecutive_mutations",
+                 "direct_encoding", "node_names", "node_types", "node_functions", "edge_sources", "edge_targets",
+                 "edge_weights", "compiled", "edge_candidates", "input_size_xyz", "output_states"]
+
+    input_node_names = CPPN.input_node_names
+    activation_functions = CPPN.activation_functions
+
+    def __init__(self, output_node_names, mutate=True):
+        self.output_node_names = output_node_names
+        self.freeze = False
+        self.allow_neutral_mutations = False
+        self.num_consecutive_mutations = 1
+        self.direct_encoding = False
+        self.node_names = []
+        self.node_types = []
+        self.node_functions = []
+        self.edge_sources = []  # edges are kept in the order networkx would list the in edges of each node
+        self.edge_targets = []
+        self.edge_weights = []
+        self.compiled = None  # CompiledCPPN, dropped whenever the topology changes
+        self.edge_candidates = None  # edges which add_link may create, see get_edge_candidates
+        self.input_size_xyz = None
+        self.output_states = {}
+        if mutate:
+            self.set_minimal_graph()
+            self.mutate()
+
+    @classmethod
+    def from_cppn(cls, cppn):
+        """Return a CompactCPPN with the same nodes, edges and functions as cppn, evaluated in the same order."""
+        new = cls(list(cppn.output_node_names), mutate=False)
+        for attr in ["freeze", "allow_neutral_mutations", "num_consecutive_mutations"]:
+            setattr(new, attr, getattr(cppn, attr))
+        for name in cppn.graph.nodes():
+            new.add_graph_node(name, cppn.graph.node[name]["type"], cppn.graph.node[name]["function"])
+        for name in cppn.graph.nodes():
+            for node1, node2 in cppn.graph.in_edges(nbunch=[name]):
+                new.add_graph_edge(node1, node2, cppn.graph.edge[node1][node2]["weight"])
+        return new
+
+    def __deepcopy__(self, memo):
+        """Share the output states and the edge candidates instead of copying them, see CPPN.__deepcopy__."""
+        if self.compiled is not None:
+            self.compiled.share_states(memo)
+        if self.edge_candidates is not None:
+            memo[id(self.edge_candidates)] = self.edge_candidates
+        new = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(new, name, deepcopy(getattr(self, name), memo))
+        return new
+
+    def __getstate__(self):
+        """Leave the edge candidates out of checkpoints, they are rebuilt when needed."""
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        state["edge_candidates"] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def graph(self):
+        """Build an equivalent networkx graph. It is read-only: a new graph is built on every access."""
+        graph = OrderedGraph()
+        for name, node_type, function in zip(self.node_names, self.node_types, self.node_functions):
+            graph.add_node(name, type=node_type, function=function)
+        for node1, node2, weight in zip(self.edge_sources, self.edge_targets, self.edge_weights):
+            graph.add_edge(node1, node2, weight=weight)
+        return graph
+
+    def get_output_state(self, name):
+        """Return the state of an output node computed by the last expression."""
+        return self.output_states[name]
+
+    def set_minimal_graph(self):
+        """Create a simple graph with each input attached to each output"""
+        for name in self.input_node_names:
+            self.add_graph_node(name, "input", None)
+
+        for name in self.output_node_names:
+            self.add_graph_node(name, "output", sigmoid)
+
+        for input_node in self.input_node_names:
+            for output_node in self.output_node_names:
+                self.add_graph_edge(input_node, output_node, 0.0)
+
+    def set_input_node_states(self, orig_size_xyz, dtype=np.float64):
+        self.input_size_xyz = tuple(orig_size_xyz)
+
+    def calc_output_states(self, orig_size_xyz, to_phenotype_mapping, dtype=np.float64, chunk_size=None):
+        """Propagate the input states through the network, keeping the output states only (see CPPN)."""
+        if self.compiled is None:
+            self.compiled = CompiledCPPN(self, to_phenotype_mapping)
+        if chunk_size is None:
+            self.compiled.run(self, orig_size_xyz, dtype)
+        else:
+            self.compiled.run_chunked(self, orig_size_xyz, dtype, chunk_size)
+
+    def store_states(self, node_states, output_states):
+        """Keep the output states computed by a CompiledCPPN, the states of the other nodes are not stored."""
+        self.output_states = dict(output_states)
+
+    def reset_old_states(self):
+        """Nothing to clear: no state is kept per node. See CPPN.reset_old_states."""
+        pass
+
+    def release_states(self):
+        """Drop the states cached by the compiled network, keep the output states. See CPPN.release_states."""
+        self.output_states = dict((name, _detached(state)) for name, state in self.output_states.items())
+        if self.compiled is not None:
+            self.compiled.release()
+
+    def mutate(self, num_random_node_adds=5, num_random_node_removals=0, num_random_link_adds=10,
+               num_random_link_removals=5, num_random_activation_functions=100, num_random_weight_changes=100):
+
+        variation_degree = None
+        variation_type = None
+
+        for _ in range(num_random_node_adds):
+            variation_degree = self.add_node()
+            variation_type = "add_node"
+
+        for _ in range(num_random_node_removals):
+            variation_degree = self.remove_node()
+            variation_type = "remove_node"
+
+        for _ in range(num_random_link_adds):
+            variation_degree = self.add_link()
+            variation_type = "add_link"
+
+        for _ in range(num_random_link_removals):
+            variation_degree = self.remove_link()
+            variation_type = "remove_link"
+
+        for _ in range(num_random_activation_functions):
+            variation_degree = self.mutate_function()
+            variation_type = "mutate_function"
+
+        for _ in range(num_random_weight_changes):
+            variation_degree = self.mutate_weight()
+            variation_type = "mutate_weight"
+
+        self.prune_network()
+        return variation_type, variation_degree
+
+    ###############################################
+    #   Mutation functions
+    ###############################################
+
+    def add_node(self):
+        # choose a random edge, a new node will be inserted along it
+        if len(self.edge_sources) == 0:
+            return "NoEdges"
+        this_edge = random.randrange(len(self.edge_sources))
+        node1, node2, weight = self.edge_sources[this_edge], self.edge_targets[this_edge], self.edge_weights[this_edge]
+
+        # create a new node hanging from the previous output node, connected to the previous input node through the
+        # weight of the removed edge to minimize disruption
+        new_node_index = self.get_max_hidden_node_index()
+        self.add_graph_node(new_node_index, "hidden", random.choice(self.activation_functions))
+        self.add_graph_edge(new_node_index, node2, 1.0)
+        self.remove_graph_edge(this_edge)
+        self.add_graph_edge(node1, new_node_index, weight)
+        return ""
+
+    def remove_node(self):
+        hidden_nodes = [name for name, node_type in zip(self.node_names, self.node_types) if node_type == "hidden"]
+        if len(hidden_nodes) == 0:
+            return "NoHiddenNodes"
+        this_node = random.choice(hidden_nodes)
+
+        # if there are edge paths going through this node, keep them connected to minimize disruption
+        incoming_edges = [k for k, target in enumerate(self.edge_targets) if target == this_node]
+        outgoing_edges = [k for k, source in enumerate(self.edge_sources) if source == this_node]
+        new_edges = [(self.edge_sources[k1], self.edge_targets[k2], self.edge_weights[k1] * self.edge_weights[k2])
+                     for k1 in incoming_edges for k2 in outgoing_edges]
+        for node1, node2, weight in new_edges:
+            self.add_graph_edge(node1, node2, weight)
+
+        self.remove_graph_node(this_node)
+        return ""
+
+    def add_link(self):
+        # choose two random nodes between which a link could exist, *but doesn't*: see get_edge_candidates
+        edge_candidates = self.get_edge_candidates()
+        if len(edge_candidates) == 0:
+            return "NoValidEdges"
+        node1, node2 = random.choice(edge_candidates)
+
+        # create a link between them
+        if random.random() > 0.5:
+            self.add_graph_edge(node1, node2, 0.1)
+        else:
+            self.add_graph_edge(node1, node2, -0.1)
+
+        # the new link rules out itself and any link from node2 or its descendants to node1 or its ancestors
+        downstream = self.get_reachable_nodes([node2], self.edge_sources, self.edge_targets)
+        upstream = self.get_reachable_nodes([node1], self.edge_targets, self.edge_sources)
+        self.edge_candidates = [(source, target) for source, target in edge_candidates
+                                if not (source in downstream and target in upstream) and
+                                (source, target) != (node1, node2)]
+        return ""
+
+    def remove_link(self):
+        if len(self.edge_sources) == 0:
+            return "NoEdges"
+        self.remove_graph_edge(random.randrange(len(self.edge_sources)))
+        return ""
+
+    def mutate_function(self):
+        this_node = random.randrange(len(self.node_names))
+        while self.node_types[this_node] == "input":
+            this_node = random.randrange(len(self.node_names))
+        old_function = self.node_functions[this_node]
+        while self.node_functions[this_node] == old_function:
+            self.node_functions[this_node] = random.choice(self.activation_functions)
+        if self.compiled is not None:
+            self.compiled.set_function(self.node_names[this_node], self.node_functions[this_node])
+        return old_function.__name__ + "-to-" + self.node_functions[this_node].__name__
+
+    def mutate_weight(self, mutation_std=0.5):
+        if len(self.edge_sources) == 0:
+            return "NoEdges"
+        this_edge = random.randrange(len(self.edge_sources))
+        old_weight = self.edge_weights[this_edge]
+        new_weight = old_weight
+        while old_weight == new_weight:
+            new_weight = random.gauss(old_weight, mutation_std)
+            new_weight = max(-1.0, min(new_weight, 1.0))
+        self.edge_weights[this_edge] = new_weight
+        if self.compiled is not None:
+            self.compiled.set_weight(self.edge_sources[this_edge], self.edge_targets[this_edge], new_weight)
+        return float(new_weight - old_weight)
+
+    ###############################################
+    #   Helper functions for mutation
+    ###############################################
+
+    def add_graph_node(self, name, node_type, function):
+        self.node_names += [name]
+        self.node_types += [node_type]
+        self.node_functions += [function]
+        self.compiled = None
+        self.edge_candidates = None
+
+    def remove_graph_node(self, name):
+        """Remove a node and its edges."""
+        for k in reversed(range(len(self.edge_sources))):
+            if name in (self.edge_sources[k], self.edge_targets[k]):
+                self.remove_graph_edge(k)
+        k = self.node_names.index(name)
+        for nodes_list in [self.node_names, self.node_types, self.node_functions]:
+            del nodes_list[k]
+        self.compiled = None
+        self.edge_candidates = None
+
+    def add_graph_edge(self, node1, node2, weight):
+        """Add an edge, or only change its weight if it exists (as networkx's add_edge)."""
+        for k in range(len(self.edge_sources)):
+            if self.edge_sources[k] == node1 and self.edge_targets[k] == node2:
+                self.edge_weights[k] = weight
+                if self.compiled is not None:
+                    self.compiled.set_weight(node1, node2, weight)
+                return
+        self.edge_sources += [node1]
+        self.edge_targets += [node2]
+        self.edge_weights += [weight]
+        self.compiled = None
+        self.edge_candidates = None
+
+    def remove_graph_edge(self, k):
+        for edges_list in [self.edge_sources, self.edge_targets, self.edge_weights]:
+            del edges_list[k]
+        self.compiled = None
+        self.edge_candidates = None
+
+    def prune_network(self):
+        """Remove erroneous nodes and edges post mutation. See CPPN.prune_network."""
+        anchors = [name for name, node_type in zip(self.node_names, self.node_types) if node_type != "hidden"]
+        connected = self.get_reachable_nodes(anchors, self.edge_sources, self.edge_targets) & \
+            self.get_reachable_nodes(anchors, self.edge_targets, self.edge_sources)
+        if len(connected) < len(self.node_names):
+            keep = [k for k, name in enumerate(self.node_names) if name in connected]
+            for nodes_list in [self.node_names, self.node_types, self.node_functions]:
+                nodes_list[:] = [nodes_list[k] for k in keep]
+            keep = [k for k, (node1, node2) in enumerate(zip(self.edge_sources, self.edge_targets))
+                    if node1 in connected and node2 in connected]
+            for edges_list in [self.edge_sources, self.edge_targets, self.edge_weights]:
+                edges_list[:] = [edges_list[k] for k in keep]
+            self.compiled = None
+            self.edge_candidates = None
+
+    def get_max_hidden_node_index(self):
+        max_index = 0
+        for name, node_type in zip(self.node_names, self.node_types):
+            if node_type == "hidden" and int(name) >= max_index:
+                max_index = name + 1
+        return max_index
+
+    def get_reachable_nodes(self, names, edge_starts, edge_ends):
+        """Return the set of nodes reachable from names (included) following the edges from edge_starts to edge_ends."""
+        next_nodes = {}
+        for start, end in zip(edge_starts, edge_ends):
+            next_nodes.setdefault(start, []).append(end)
+        return _reachable_nodes(names, next_nodes)
+
+    def get_edge_candidates(self):
+        """Return the edges which can be added to the graph, in node order, building the list if needed.
+
+        See CPPN.get_edge_candidates.
+
+        """
+        if self.edge_candidates is None:
+            edges = set(zip(self.edge_sources, self.edge_targets))
+            edge_candidates = []
+            for node1, type1 in zip(self.node_names, self.node_types):
+                ancestors = self.get_reachable_nodes([node1], self.edge_targets, self.edge_sources)
+                for node2, type2 in zip(self.node_names, self.node_types):
+                    if type1 != "output" and type2 != "input" and node2 not in ancestors and \
+                            (node1, node2) not in edges and (node2, node1) not in edges:
+                        edge_candidates += [(node1, node2)]
+            self.edge_candidates = edge_candidates
+        return self.edge_candidates
+
+
+class CompiledCPPN(object):
+    """A CPPN flattened into a list of operations, one per node, in the order its recursive evaluation visits them.
+
+    The recursive evaluation hands the activated state of a node to the first node requesting it, and the raw (weighted
+    sum) state to any later one. Outputs are evaluated in order and their state is cleared beforehand: an output which
+    was already evaluated as the source of a previous output is left to zeros, otherwise its activated state is kept and
+    handed to any later request. The compiled sources keep this behavior so the outputs are bit-identical.
+
+    The compilation only depends on the topology: weight and activation function mutations are patched in place. Node
+    states are computed with in-place NumPy operations into buffers, one per slot, reused between expressions. The
+    buffers also cache the states of the last run: the operations whose weights or function were patched since are
+    marked as dirty, and only them and their downstream cone are computed again. The cache is shared copy-on-write with
+    the copies of the network, so that mutants start from the states of their parent: only the buffers of the operations
+    a network computes again are allocated. It is not pickled.
+
+    """
+
+    def __init__(self, network, to_phenotype_mapping):
+        self.input_slots = OrderedDict()  # input node name -> slot of its state
+        self.node_names = []
+        self.raw_slots = []  # slot of the weighted sum of the inputs of each node
+        self.act_slots = []  # slot of the activated state of each node
+        self.sources = []  # slots added up by each node
+        self.weights = []  # weights of the sources
+        self.functions = []
+        self.mapped = []  # True if the function comes from the phenotype mapping
+        self.levels = []  # depth of each node: one more than its deepest source
+        self.output_slots = []  # slot of the final state of each output node
+        self.zero_slots = []
+        self.op_index = {}  # node name -> index of its operation
+        self.term_index = {}  # edge -> index of its weight among the node's sources
+        self.num_slots = 0
+        self.states = None  # (cached) state of each slot, None if there are no valid states
+        self.state_key = None  # (size, dtype) of the cached states
+        self.buffers = {}  # slot -> buffer owned by this network, which its states are computed into
+        self.dirty = None  # operations to compute again, None if there are no valid states
+        self.arrays = None
+
+        graph = network.graph
+        for name in network.input_node_names:
+            if graph.has_node(name):
+                self.input_slots[name] = self.new_slot()
+
+        handed_slots = dict(self.input_slots)  # slot handed to later requests of an evaluated node
+        slot_levels = dict((slot, 0) for slot in self.input_slots.values())
+
+        def visit(node_name):
+            if node_name in handed_slots:
+                return handed_slots[node_name]
+
+            raw_slot = self.new_slot()
+            handed_slots[node_name] = raw_slot
+
+            sources, weights = [], []
+            for node1, node2 in graph.in_edges(nbunch=[node_name]):
+                self.term_index[(node1, node2)] = len(weights)
+                sources += [visit(node1)]
+                weights += [graph.edge[node1][node2]["weight"]]
+
+            level = 1 + max([slot_levels[slot] for slot in sources] + [0])
+            slot_levels[raw_slot] = level
+
+            mapped = node_name in to_phenotype_mapping and \
+                to_phenotype_mapping[node_name]["dependency_order"] is None
+
+            self.op_index[node_name] = len(self.node_names)
+            self.node_names += [node_name]
+            self.raw_slots += [raw_slot]
+            self.act_slots += [self.new_slot()]
+            self.sources += [sources]
+            self.weights += [weights]
+            self.functions += [to_phenotype_mapping[node_name]["func"] if mapped
+                               else graph.node[node_name]["function"]]
+            self.mapped += [mapped]
+            self.levels += [level]
+            slot_levels[self.act_slots[-1]] = level
+            return self.act_slots[-1]
+
+        for name in network.output_node_names:
+            if name in handed_slots:
+                self.zero_slots += [self.new_slot()]
+                self.output_slots += [self.zero_slots[-1]]
+                slot_levels[self.zero_slots[-1]] = 0
+            else:
+                self.output_slots += [visit(name)]
+            handed_slots[name] = self.output_slots[-1]
+        self.output_node_names = list(network.output_node_names)
+
+    def __deepcopy__(self, memo):
+        """Share the compiled topology, which is never modified, and only copy what mutations patch in place.
+
+        The cached states are shared copy-on-write: neither the copy nor the original owns their buffers anymore, the
+        next run of each allocates new buffers for the operations it computes again.
+
+        """
+        cls = self.__class__
+        new = cls.__new__(cls)
+        new.__dict__.update(self.__dict__)
+        new.weights = [list(weights) for weights in self.weights]
+        new.functions = list(self.functions)
+        if self.states is not None:
+            new.states = list(self.states)
+            new.dirty = set(self.dirty)
+        new.buffers = {}
+        self.buffers = {}
+        return new
+
+    def share_states(self, memo):
+        """Register the cached states in a deepcopy memo, so that the copies of the network share them."""
+        if self.states is not None:
+            for state in self.states:
+                memo[id(state)] = state
+
+    def __getstate__(self):
+        """Leave the cached states out of checkpoints, they are computed again on the next run."""
+        state = self.__dict__.copy()
+        state["states"] = None
+        state["state_key"] = None
+        state["buffers"] = {}
+        state["dirty"] = None
+        state["arrays"] = None
+        return state
+
+    def __setstate__(self, state):
+        if "overrides" in state:  # older checkpoints cached the states in a single block
+            del state["overrides"]
+            state.update(states=None, state_key=None, buffers={})
+        self.__dict__.update(state)
+
+    def get_arrays(self):
+        """Return the compiled topology as flat arrays, built once and used to evaluate many networks together."""
+        if self.arrays is None:
+            num_terms = np.array([len(sources) for sources in self.sources], dtype=int)
+            term_ops = np.repeat(np.arange(len(self.sources)), num_terms)
+            self.arrays = {"raw_slots": np.array(self.raw_slots, dtype=int),
+                           "act_slots": np.array(self.act_slots, dtype=int),
+                           "zero_slots": np.array(self.zero_slots, dtype=int),
+                           "levels": np.array(self.levels, dtype=int),
+                           "sources": np.array(list(chain.from_iterable(self.sources)), dtype=int),
+                           "term_ops": term_ops,  # operation adding up each term
+                           "terms": np.arange(len(term_ops)) - np.repeat(np.cumsum(num_terms) - num_terms, num_terms)}
+        return self.arrays
+
+    def new_slot(self):
+        self.num_slots += 1
+        return self.num_slots - 1
+
+    def set_weight(self, node1, node2, weight):
+        if node2 in self.op_index:
+            self.weights[self.op_index[node2]][self.term_index[(node1, node2)]] = weight
+            if self.dirty is not None:
+                self.dirty.add(self.op_index[node2])
+
+    def set_function(self, node_name, function):
+        if node_name in self.op_index and not self.mapped[self.op_index[node_name]]:
+            self.functions[self.op_index[node_name]] = function
+            if self.dirty is not None:
+                self.dirty.add(self.op_index[node_name])
+
+    def release(self):
+        """Drop the cached states: the next run computes all the operations."""
+        self.states = None
+        self.state_key = None
+        self.buffers = {}
+        self.dirty = None
+
+    def has_cache(self, orig_size_xyz, dtype=np.float64):
+        """Return True if the cached states are those of a previous run of this size and type."""
+        return self.dirty is not None and self.state_key == (tuple(orig_size_xyz), np.dtype(dtype))
+
+    def get_ops_to_run(self, orig_size_xyz, dtype=np.float64):
+        """Return the indices of the operations to compute: all of them, or the downstream cone of the dirty ones."""
+        if not self.has_cache(orig_size_xyz, dtype):
+            return range(len(self.node_names))
+        ops, changed_slots = [], set()
+        for k in range(len(self.node_names)):
+            if k in self.dirty or any(slot in changed_slots for slot in self.sources[k]):
+                ops += [k]
+                changed_slots.update([self.raw_slots[k], self.act_slots[k]])
+        return ops
+
+    def set_states(self, states, orig_size_xyz, dtype=np.float64):
+        """Cache the state of each slot, computed by a run of this size and type."""
+        self.states = states
+        self.state_key = (tuple(orig_size_xyz), np.dtype(dtype))
+        self.dirty = set()
+
+    def store_states(self, network):
+        """Hand the cached node states to network.store_states()."""
+        network.store_states([(name, self.states[slot]) for name, slot in zip(self.node_names, self.raw_slots)],
+                             [(name, self.states[slot]) for name, slot in zip(self.output_node_names,
+                                                                              self.output_slots)])
+
+    def run(self, network, orig_size_xyz, dtype=np.float64):
+        """Compute the node states from the shared input grids, and hand them to network.store_states().
+
+        Only the operations returned by get_ops_to_run are computed, into buffers owned by this network: those shared
+        with another network (see __deepcopy__) are left untouched.
+
+        """
+        orig_size_xyz = tuple(orig_size_xyz)
+        ops = self.get_ops_to_run(orig_size_xyz, dtype)
+        if not self.has_cache(orig_size_xyz, dtype):
+            self.states = [None] * self.num_slots
+            self.buffers = {}
+            for slot in self.zero_slots:
+                self.states[slot] = np.zeros(orig_size_xyz, dtype=dtype)
+
+        for k in ops:
+            slots = [self.raw_slots[k]] + ([self.act_slots[k]] if self.functions[k] in IN_PLACE_FUNCTIONS else [])
+            for slot in slots:
+                if slot not in self.buffers:
+                    self.buffers[slot] = np.empty(orig_size_xyz, dtype=dtype)
+
+        values = self.states + [np.empty(orig_size_xyz, dtype=dtype)]  # scratch space
+        input_grids = get_input_grids(orig_size_xyz, dtype)
+        for name, slot in self.input_slots.items():
+            values[slot] = input_grids[name]
+
+        self.compute(ops, values, self.buffers)
+        self.set_states(values[:-1], orig_size_xyz, dtype)
+        self.store_states(network)
+
+    def run_chunked(self, network, orig_size_xyz, dtype=np.float64, chunk_size=8):
+        """Compute the output states slab by slab along z, holding the states of a single slab of chunk_size layers.
+
+        The output states are written into arrays of the full size, the states of the other nodes are not kept (they
+        are handed to network.store_states() as None). All the functions must be elementwise.
+
+        """
+        orig_size_xyz = tuple(orig_size_xyz)
+        input_grids = get_input_grids(orig_size_xyz, dtype)
+        block = np.empty((self.num_slots + 1,) + orig_size_xyz[:2] + (min(chunk_size, orig_size_xyz[2]),), dtype=dtype)
+        output_states = [None] * len(self.output_slots)
+
+        for z_start in range(0, orig_size_xyz[2], chunk_size):
+            z_stop = min(z_start + chunk_size, orig_size_xyz[2])
+            buffers = block[..., :z_stop - z_start]
+            buffers[self.zero_slots] = 0
+            values = list(buffers)
+            for name, slot in self.input_slots.items():
+                values[slot] = input_grids[name][:, :, z_start:z_stop]
+
+            self.compute(range(len(self.node_names)), values, buffers)
+
+            for n, slot in enumerate(self.output_slots):
+                if output_states[n] is None:
+                    output_states[n] = np.empty(orig_size_xyz, dtype=values[slot].dtype)
+                output_states[n][:, :, z_start:z_stop] = values[slot]
+
+        self.release()  # the cached states, if any, are outdated
+
+        network.store_states([(name, None) for name in self.node_names], zip(self.output_node_names, output_states))
+
+    def compute(self, ops, values, buffers):
+        """Compute the operations ops, updating the list of slot states values.
+
+        Parameters
+        ----------
+        ops : list of int
+            Indices of the operations to compute, in order.
+
+        values : list of numpy.ndarray
+            The state of each slot, followed by scratch space.
+
+        buffers : numpy.ndarray or dict
+            The buffers the states of the slots are computed into, indexed by slot. The activated states of functions
+            which can't be computed in place are returned by the function instead.
+
+        """
+        product = values[-1]
+        for k in ops:
+            new_state = values[self.raw_slots[k]] = buffers[self.raw_slots[k]]
+            new_state.fill(0)
+            for slot, weight in zip(self.sources[k], self.weights[k]):
+                np.multiply(values[slot], weight, out=product)
+                new_state += product
+
+            function = self.functions[k]
+            act_slot = self.act_slots[k]
+            if function in IN_PLACE_FUNCTIONS:
+                values[act_slot] = buffers[act_slot]
+                IN_PLACE_FUNCTIONS[function](new_state, values[act_slot])
+            else:
+                values[act_slot] = function(new_state)
+
+
+def calc_all_output_states(networks, orig_size_xyz, to_phenotype_mappings, dtype=np.float64):
+    """Evaluate many CPPNs together, handing the new node states to the store_states() method of each network.
+
+    The compiled nodes of all the networks are stacked and scheduled by level: each level adds up the weighted sources
+    of all its nodes one term at a time, then applies each activation function once to all the nodes using it. The
+    input grids are stored only once. As in CompiledCPPN.run, only the downstream cone of the dirty nodes of a network
+    holding cached states is computed again, and the new states of each network are cached in a block of its own. The
+    node states are bit-identical to those of calc_output_states.
+
+    Parameters
+    ----------
+    networks : list of CPPN or CompactCPPN
+        The networks to evaluate.
+
+    orig_size_xyz : 3-tuple (x, y, z)
+        The size of the states, shared by all the networks.
+
+    to_phenotype_mappings : list of GenotypeToPhenotypeMap
+        The phenotype mapping of the genotype of each network.
+
+    dtype : numpy float type
+        The type of the states.
+
+    """
+    state_shape = tuple(orig_size_xyz)
+    weight_shape = (-1,) + (1,) * len(state_shape)
+
+    compiled, arrays, run_ops = [], [], []
+    for network, mapping in zip(networks, to_phenotype_mappings):
+        if network.compiled is None:
+            network.compiled = CompiledCPPN(network, mapping)
+        compiled += [network.compiled]
+        arrays += [network.compiled.get_arrays()]
+        run_ops += [np.zeros(len(network.compiled.node_names), dtype=bool)]
+        run_ops[-1][network.compiled.get_ops_to_run(orig_size_xyz, dtype)] = True
+    run_ops = np.concatenate(run_ops)
+
+    # the slots of all the networks, one after the other, are mapped onto rows of the stacked values: the inputs, then
+    # the raw states of all the nodes, their activated states and the zeroed outputs
+    input_grids = get_input_grids(orig_size_xyz, dtype)
+    input_rows = OrderedDict()  # input node name -> row
+    input_slots, input_slot_rows = [], []
+    slot_offset = 0
+    for program in compiled:
+        for name, slot in program.input_slots.items():
+            input_rows.setdefault(name, len(input_rows))
+            input_slots += [slot + slot_offset]
+            input_slot_rows += [input_rows[name]]
+        slot_offset += program.num_slots
+
+    num_slots = np.array([program.num_slots for program in compiled], dtype=int)
+    num_ops = np.array([len(program.node_names) for program in compiled], dtype=int)
+    num_terms = np.array([len(a["terms"]) for a in arrays], dtype=int)
+    num_zeros = np.array([len(program.zero_slots) for program in compiled], dtype=int)
+    slot_offsets = np.cumsum(num_slots) - num_slots
+    num_inputs, num_nodes = len(input_rows), np.sum(num_ops)
+
+    def stack(key, counts, offsets):
+        return np.concatenate([a[key] for a in arrays]) + np.repeat(offsets, counts)
+
+    raw_slots = stack("raw_slots", num_ops, slot_offsets)
+    slot_rows = np.empty(np.sum(num_slots), dtype=int)
+    slot_rows[input_slots] = input_slot_rows
+    slot_rows[raw_slots] = np.arange(num_inputs, num_inputs + num_nodes)
+    slot_rows[stack("act_slots", num_ops, slot_offsets)] = slot_rows[raw_slots] + num_nodes
+    slot_rows[stack("zero_slots", num_zeros, slot_offsets)] = num_inputs + 2 * num_nodes + np.arange(np.sum(num_zeros))
+
+    levels = np.concatenate([a["levels"] for a in arrays])
+    sources = slot_rows[stack("sources", num_terms, slot_offsets)]
+    term_rows = stack("term_ops", num_terms, np.cumsum(num_ops) - num_ops) + num_inputs
+    terms = np.concatenate([a["terms"] for a in arrays])
+    weights = np.fromiter(chain.from_iterable(chain.from_iterable(program.weights for program in compiled)),
+                          dtype=float, count=np.sum(num_terms)).astype(dtype)
+    functions = OrderedDict()  # activation function -> code
+    function_codes = np.array([functions.setdefault(function, len(functions))
+                               for program in compiled for function in program.functions], dtype=int)
+    functions = list(functions)
+
+    values = np.empty((num_inputs + 2 * num_nodes + np.sum(num_zeros),) + state_shape, dtype=dtype)
+    overrides = {}  # row -> state returned by a function which can't be applied to stacked arrays
+    for name, row in input_rows.items():
+        values[row] = input_grids[name]
+    for program, slot_offset in zip(compiled, slot_offsets):
+        if program.has_cache(orig_size_xyz, dtype):
+            input_slots = set(program.input_slots.values())
+            for slot, state in enumerate(program.states):
+                if slot not in input_slots:
+                    values[slot_rows[slot_offset + slot]] = state
+            for function, slot in zip(program.functions, program.act_slots):
+                if function not in IN_PLACE_FUNCTIONS:
+                    overrides[slot_rows[slot_offset + slot]] = program.states[slot]
+    values[num_inputs + np.flatnonzero(run_ops)] = 0
+    values[num_inputs + 2 * num_nodes:] = 0
+
+    # group the terms of the nodes to compute by (level of their node, position among its sources), and these nodes by
+    # (level, function)
+    term_mask = run_ops[term_rows - num_inputs]
+    term_rows, sources, terms, weights = term_rows[term_mask], sources[term_mask], terms[term_mask], weights[term_mask]
+    term_levels = levels[term_rows - num_inputs]
+    term_keys = term_levels * (np.max(terms) + 1 if len(terms) > 0 else 1) + terms
+    term_groups = _split_groups(np.lexsort((terms, term_levels)), term_keys)
+    nodes = np.flatnonzero(run_ops)
+    node_order = nodes[np.lexsort((function_codes[nodes], levels[nodes]))]
+    node_groups = _split_groups(node_order, levels * len(functions) + function_codes)
+
+    t = 0
+    for group in node_groups:
+        level = levels[group[0]]
+        while t < len(term_groups) and term_levels[term_groups[t][0]] == level:
+            group_terms = term_groups[t]
+            values[term_rows[group_terms]] += values[sources[group_terms]] * weights[group_terms].reshape(weight_shape)
+            t += 1
+
+        function = functions[function_codes[group[0]]]
+        raw_rows = group + num_inputs
+        if function in IN_PLACE_FUNCTIONS:  # elementwise
+            values[raw_rows + num_nodes] = function(values[raw_rows])
+            if len(overrides) > 0:
+                for row in raw_rows:
+                    overrides.pop(row + num_nodes, None)
+        else:
+            for row in raw_rows:
+                overrides[row + num_nodes] = function(values[row])
+                values[row + num_nodes] = overrides[row + num_nodes]
+
+    # cache the states of each network in a block of its own, which the stored states are views of
+    for network, program, slot_offset in zip(networks, compiled, slot_offsets):
+        rows = slot_rows[slot_offset:slot_offset + program.num_slots]
+        block = values[rows]
+        states = list(block)
+        program.buffers = dict((slot, block[slot]) for slot in program.raw_slots + program.act_slots)
+        if len(overrides) > 0:
+            for slot in program.act_slots:
+                if rows[slot] in overrides:
+                    states[slot] = overrides[rows[slot]]
+                    del program.buffers[slot]
+        program.set_states(states, orig_size_xyz, dtype)
+        program.store_states(network)
+
+
+def _split_groups(order, keys):
+    """Split the indices sorted by order into runs of equal keys."""
+    sorted_keys = keys[order]
+    bounds = [0] + list(np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1) + [len(order)]
+    return [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def _sample_without_replacement(num_elements, num_samples):
+    """Return num_samples distinct indices drawn uniformly from range(num_elements).
+
+    Indices are drawn with replacement until enough distinct ones are found, which only costs O(num_samples) when
+    num_samples is small compared to num_elements.
+
+    """
+    if num_samples > num_elements / 2:
+        return np.random.permutation(num_elements)[:num_samples]
+    samples = np.unique(np.random.randint(num_elements, size=num_samples))
+    while len(samples) < num_samples:
+        samples = np.union1d(samples, np.random.randint(num_elements, size=num_samples - len(samples)))
+    return samples
+
+
 class DirectEncoding(Network):
     def __init__(self, output_node_name, orig_size_xyz, lower_bound=-1, upper_bound=1, func=None, symmetric=True,
                  p=None, scale=None, start_val=None, mutate_start_val=False):
@@ -347,22 +1289,44 @@ class DirectEncoding(Network):
         pass
 
     def mutate(self, rate=None):
+        """Add gaussian noise to the values of the voxels, each one being selected with probability rate.
+
+        Only the selected voxels are drawn and updated: their number is drawn from a binomial distribution, then their
+        indices are sampled. When rate holds one probability per voxel, the voxels are drawn with the largest one, then
+        each is kept with probability rate / largest rate. Clipping, symmetry and func are applied to the changed voxels
+        only (func is expected to be elementwise and idempotent, e.g. a rounding).
+
+        """
         if rate is None:
             rate = self.p
 
+        max_rate = min(max(np.max(rate), 0.0), 1.0)
+        selection = _sample_without_replacement(self.values.size, np.random.binomial(self.values.size, max_rate))
+        if np.ndim(rate) > 0:
+            selection = selection[np.random.random(len(selection)) * max_rate < np.ravel(rate)[selection]]
+        x, y, z = np.unravel_index(selection, self.values.shape)
+
         scale = self.scale
         if self.scale is None:
-            scale = np.clip(self.values**0.5, self.start_value**0.5, self.upper_bound)
+            scale = np.clip(self.values[x, y, z]**0.5, self.start_value**0.5, self.upper_bound)
             # right not the only time this occurs is for meta mutations
             # assuming values are less than 1, ow this should be 1/val
 
-        selection = np.random.random(self.size) < rate
-        change = np.random.normal(scale=scale, size=self.size)
-        self.values[selection] += change[selection]
-        self.values = np.clip(self.values, self.lower_bound, self.upper_bound)
-        self.enforce_symmetry()
+        change = np.random.normal(scale=scale, size=len(selection))
+        self.values[x, y, z] = np.clip(self.values[x, y, z] + change, self.lower_bound, self.upper_bound)
+
+        if self.symmetric:
+            # as enforce_symmetry: changes in the first half are undone, those in the second half are mirrored
+            half = int(self.size[0]/2.0)
+            mirrored_x = self.size[0] - 1 - x
+            first, second = x < half, mirrored_x < half
+            self.values[x[first], y[first], z[first]] = self.values[mirrored_x[first], y[first], z[first]]
+            self.values[mirrored_x[second], y[second], z[second]] = self.values[x[second], y[second], z[second]]
+            x, y, z = np.concatenate([x, mirrored_x[second]]), np.concatenate([y, y[second]]), \
+                np.concatenate([z, z[second]])
+
         if self.func is not None:
-            self.values = self.func(self.values)
+            self.values[x, y, z] = self.func(self.values[x, y, z])
         return "gaussian", self.scale
 
     def enforce_symmetry(self):
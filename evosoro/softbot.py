@@ -1,16 +1,25 @@
 import operator
+import weakref
+import random
+import multiprocessing
 import numpy as np
 from copy import deepcopy
 import math
+from collections import OrderedDict
 
-from evosoro.networks import Network
+from evosoro.networks import Network, CompactCPPN, calc_all_output_states
 from evosoro.tools.utils import sigmoid, xml_format, dominates
 
 
 class Genotype(object):
     """A container for multiple networks, 'genetic code' copied with modification to produce offspring."""
 
-    def __init__(self, orig_size_xyz=(6, 6, 6)):
+    # defaults for genotypes pickled before these options were introduced
+    dtype = np.float64
+    chunk_size = None
+    keep_node_states = True
+
+    def __init__(self, orig_size_xyz=(6, 6, 6), dtype=np.float64, chunk_size=None, keep_node_states=True):
 
         """
         Parameters
@@ -19,11 +28,28 @@ class Genotype(object):
             Defines the original 3 dimensions for the cube of voxels corresponding to possible networks outputs. The
             maximum number of SofBot voxel components is x*y*z, a full cube.
 
+        dtype : numpy float type
+            The type of the network states, the direct encoding values and the float phenotype states. np.float32 halves
+            the memory and copy traffic of the genotypes, at the cost of precision.
+
+        chunk_size : int
+            High resolution mode: the CPPN outputs are evaluated by slabs of chunk_size z layers, and the states of the
+            hidden nodes are not kept, so that expression only holds a bounded number of full size arrays. None
+            evaluates the whole lattice at once.
+
+        keep_node_states : bool
+            If False, only the output states are kept after expression: the states of the hidden nodes and the states
+            cached to recompute only the nodes affected by a mutation are released (see CPPN.release_states). This
+            shrinks the copies and the checkpoints of the genotypes, but every expression computes all the nodes.
+
         """
         self.networks = []
         self.all_networks_outputs = []
         self.to_phenotype_mapping = GenotypeToPhenotypeMap()
         self.orig_size_xyz = orig_size_xyz
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.keep_node_states = keep_node_states
 
     def __iter__(self):
         """Iterate over the networks. Use the expression 'for n in network'."""
@@ -56,9 +82,11 @@ class Genotype(object):
             Uses this many (random) steps per mutation.
 
         """
-        assert isinstance(network, Network)
+        assert isinstance(network, (Network, CompactCPPN))
         network.freeze = freeze
         network.num_consecutive_mutations = num_consecutive_mutations
+        if network.direct_encoding:
+            network.values = network.values.astype(self.dtype)
         self.networks += [network]
         self.all_networks_outputs.extend(network.output_node_names)
 
@@ -67,26 +95,29 @@ class Genotype(object):
 
         for network in self:
             if not network.direct_encoding:
-                for name in network.graph.nodes():
-                    network.graph.node[name]["evaluated"] = False  # flag all nodes as unevaluated
+                network.set_input_node_states(self.orig_size_xyz, self.dtype)  # reset the inputs
+                network.calc_output_states(self.orig_size_xyz, self.to_phenotype_mapping, self.dtype,
+                                           self.chunk_size)  # calculate new outputs
+                if not self.keep_node_states:
+                    network.release_states()
 
-                network.set_input_node_states(self.orig_size_xyz)  # reset the inputs
+        self.map_output_states()
 
-                for name in network.output_node_names:
-                    network.graph.node[name]["state"] = np.zeros(self.orig_size_xyz)  # clear old outputs
-                    network.graph.node[name]["state"] = self.calc_node_state(network, name)  # calculate new outputs
+    def map_output_states(self):
+        """Calculate the phenotype mapping states from the (already calculated) networks outputs."""
 
         for network in self:
             for name in network.output_node_names:
                 if name in self.to_phenotype_mapping:
                     if not network.direct_encoding:
-                        self.to_phenotype_mapping[name]["state"] = network.graph.node[name]["state"]
+                        self.to_phenotype_mapping[name]["state"] = network.get_output_state(name)
                     else:
-                        self.to_phenotype_mapping[name]["state"] = network.values
+                        self.to_phenotype_mapping[name]["state"] = np.asarray(network.values, dtype=self.dtype)
 
         for name, details in self.to_phenotype_mapping.items():
             if name not in self.all_networks_outputs:
-                details["state"] = np.ones(self.orig_size_xyz, dtype=details["output_type"]) * -999
+                output_type = self.dtype if details["output_type"] is float else details["output_type"]
+                details["state"] = np.ones(self.orig_size_xyz, dtype=output_type) * -999
                 if details["dependency_order"] is not None:
                     for dependency_name in details["dependency_order"]:
                         self.to_phenotype_mapping.dependencies[dependency_name]["state"] = None
@@ -95,26 +126,37 @@ class Genotype(object):
             if details["dependency_order"] is not None:
                 details["state"] = details["func"](self)
 
-    def calc_node_state(self, network, node_name):
-        """Propagate input values through the network"""
-        if network.graph.node[node_name]["evaluated"]:
-            return network.graph.node[node_name]["state"]
-
-        network.graph.node[node_name]["evaluated"] = True
-        input_edges = network.graph.in_edges(nbunch=[node_name])
-        new_state = np.zeros(self.orig_size_xyz)
 
-        for edge in input_edges:
-            node1, node2 = edge
-            new_state += self.calc_node_state(network, node1) * network.graph.edge[node1][node2]["weight"]
+def express_all(genotypes):
+    """Express many genotypes at once.
 
-        network.graph.node[node_name]["state"] = new_state
+    The CPPNs of all the genotypes sharing the same size and dtype are evaluated together (see calc_all_output_states),
+    then each genotype maps its outputs to its phenotype as in Genotype.express(). The CPPNs of high resolution
+    genotypes (see chunk_size) are evaluated one by one.
 
-        if node_name in self.to_phenotype_mapping:
-            if self.to_phenotype_mapping[node_name]["dependency_order"] is None:
-                return self.to_phenotype_mapping[node_name]["func"](new_state)
-
-        return network.graph.node[node_name]["function"](new_state)
+    """
+    cppns_by_size = OrderedDict()
+    for genotype in genotypes:
+        for network in genotype:
+            if not network.direct_encoding:
+                network.set_input_node_states(genotype.orig_size_xyz, genotype.dtype)  # reset the inputs
+                if genotype.chunk_size is not None:
+                    network.calc_output_states(genotype.orig_size_xyz, genotype.to_phenotype_mapping, genotype.dtype,
+                                               genotype.chunk_size)
+                    continue
+                key = (tuple(genotype.orig_size_xyz), np.dtype(genotype.dtype))
+                cppns_by_size.setdefault(key, []).append((network, genotype))
+
+    for (size, dtype), cppns in cppns_by_size.items():
+        calc_all_output_states([network for network, _ in cppns], size,
+                               [genotype.to_phenotype_mapping for _, genotype in cppns], dtype)
+
+    for genotype in genotypes:
+        if not genotype.keep_node_states:
+            for network in genotype:
+                if not network.direct_encoding:
+                    network.release_states()
+        genotype.map_output_states()
 
 
 class GenotypeToPhenotypeMap(object):
@@ -122,6 +164,8 @@ class GenotypeToPhenotypeMap(object):
 
     # TODO: generalize dependencies from boolean to any operation (e.g. to set an env param from multiple outputs)
 
+    dependency_tables = {}  # compiled dependency trees, see get_dependency_table
+
     def __init__(self):
         self.mapping = dict()
         self.dependencies = dict()
@@ -248,15 +292,85 @@ class GenotypeToPhenotypeMap(object):
                                    "material_if_false": material_if_false,
                                    "state": None}
 
-    def get_dependency(self, name, output_bool):
-        """Checks recursively if all boolean requirements were met in dependent outputs."""
+    def get_dependency(self, name, output_bool, memo=None):
+        """Checks recursively if all boolean requirements were met in dependent outputs.
+
+        If a memo dict is given, the masks of the outputs being True are stored in it (by name) and reused, so that each
+        chain of requirements is evaluated only once.
+
+        """
+        if memo is not None and output_bool is True and name in memo:
+            return memo[name]
         if self.dependencies[name]["depends_on"] is not None:
             dependency = self.dependencies[name]["depends_on"]
             requirement = self.dependencies[name]["requirement"]
-            return np.logical_and(self.get_dependency(dependency, True) == requirement,
+            mask = np.logical_and(self.get_dependency(dependency, True, memo) == requirement,
                                   self.dependencies[name]["state"] == output_bool)
         else:
-            return self.dependencies[name]["state"] == output_bool
+            mask = self.dependencies[name]["state"] == output_bool
+        if memo is not None and output_bool is True:
+            memo[name] = mask
+        return mask
+
+    def get_dependency_table(self, dependency_order, dtype):
+        """Compile the material assignments of a dependency tree into a lookup table.
+
+        The material of a voxel only depends on the (boolean) states of the outputs in the tree at that voxel, so the
+        assignments made by make_material_tree (from the last to the first dependency in dependency_order) are
+        evaluated once on every combination of states. Tables are shared by all the mappings with the same tree.
+
+        Parameters
+        ----------
+        dependency_order : list
+            The outputs whose materials are assigned, in order of importance.
+
+        dtype : numpy.dtype
+            The type of the material state.
+
+        Returns
+        -------
+        names : list
+            The outputs whose states are the bits of the index in the table (the first is the least significant).
+
+        materials : numpy.ndarray
+            The material assigned to each combination of states.
+
+        assigned : numpy.ndarray
+            Whether a material is assigned to each combination of states (otherwise the state is left as it is).
+
+        """
+        names = []
+        for name in dependency_order:
+            while name is not None and name not in names:
+                names.append(name)
+                name = self.dependencies[name]["depends_on"]
+
+        key = (tuple(dependency_order), np.dtype(dtype).str,
+               tuple((name, self.dependencies[name]["depends_on"], self.dependencies[name]["requirement"],
+                      self.dependencies[name]["material_if_true"], self.dependencies[name]["material_if_false"])
+                     for name in names))
+        if key not in self.dependency_tables:
+            combinations = np.arange(2 ** len(names))
+            states = [self.dependencies[name]["state"] for name in names]
+            for bit, name in enumerate(names):
+                self.dependencies[name]["state"] = (combinations >> bit) & 1 == 1
+
+            materials = np.zeros(len(combinations), dtype=dtype)
+            assigned = np.zeros(len(combinations), dtype=bool)
+            memo = {}
+            for name in reversed(dependency_order):
+                for output_bool, material in [(True, self.dependencies[name]["material_if_true"]),
+                                              (False, self.dependencies[name]["material_if_false"])]:
+                    if material is not None:
+                        mask = self.get_dependency(name, output_bool, memo)
+                        materials[mask] = material
+                        assigned[mask] = True
+
+            for name, state in zip(names, states):
+                self.dependencies[name]["state"] = state
+            self.dependency_tables[key] = (names, materials, assigned)
+
+        return self.dependency_tables[key]
 
 
 class Phenotype(object):
@@ -292,13 +406,26 @@ class Phenotype(object):
         """
         for network in self.genotype:
             for output_node_name in network.output_node_names:
-                if not network.direct_encoding and np.isnan(network.graph.node[output_node_name]["state"]).any():
+                if not network.direct_encoding and _has_nan(network.get_output_state(output_node_name)):
                     return False
-                elif network.direct_encoding and np.isnan(network.values).any():
+                elif network.direct_encoding and _has_nan(network.values):
                     return False
         return True
 
 
+def _has_nan(state, chunk_size=65536):
+    """Return True if state holds a NaN, scanning it by chunks of chunk_size elements and stopping at the first NaN.
+
+    The minimum of a chunk is NaN if any of its elements is NaN, and is computed without a temporary array.
+
+    """
+    values = np.ravel(state)
+    for start in range(0, values.size, chunk_size):
+        if np.isnan(np.min(values[start:start + chunk_size])):
+            return True
+    return False
+
+
 class SoftBot(object):
     """A SoftBot is a 3D creature composed of a continuous arrangement of connected voxels with varying softness."""
 
@@ -351,10 +478,143 @@ class SoftBot(object):
         return new
 
 
+def _lost_genotype():
+    """Stand for a weak link to a genotype which is no longer available."""
+    return None
+
+
+class CompactSoftBot(object):
+    """A SoftBot with slots, expressed on demand and holding a weak link to its parent genotype.
+
+    It has the attributes of SoftBot, but takes less memory and smaller checkpoints in large populations. The objectives
+    (and their parent values), whose names are only known from the objective dictionary, are kept in a dict and read or
+    written as attributes. The phenotype is built, which expresses the genotype, the first time it is used. The parent
+    genotype is only available while it is alive elsewhere (e.g. in the population holding the parent), otherwise
+    parent_genotype is None, and it is not pickled.
+
+    """
+
+    __slots__ = ["genotype", "phenotype_class", "_phenotype", "id", "md5", "dominated_by", "pareto_level", "selected",
+                 "variation_type", "_parent_genotype", "parent_id", "age", "trajectory", "novelty", "objective_dict",
+                 "objectives"]
+
+    def __init__(self, max_id, objective_dict, genotype, phenotype):
+        """Initialize an individual, see SoftBot."""
+        self.genotype = genotype()  # initialize new random genome
+        self.phenotype_class = phenotype
+        self._phenotype = None  # calc phenotype from genome when first needed
+
+        self.id = max_id
+        self.md5 = "none"
+        self.dominated_by = []  # other individuals in the population that are superior according to evaluation
+        self.pareto_level = 0
+        self.selected = 0  # survived selection
+        self.variation_type = "newly_generated"  # (from parent)
+        self._parent_genotype = None  # randomly generated ind: the parent genotype is its own
+        self.parent_id = -1
+        self.age = 0
+        self.trajectory = []
+        self.novelty = -1
+
+        # set the objectives as attributes of self (and parent)
+        self.objective_dict = objective_dict
+        self.objectives = {}
+        for rank, details in objective_dict.items():
+            if details["name"] != "age":
+                setattr(self, details["name"], details["worst_value"])
+            setattr(self, "parent_{}".format(details["name"]), details["worst_value"])
+
+    def __getattr__(self, name):
+        """Read an objective, or its parent value, as an attribute (only called for names which aren't slots)."""
+        if name == "objectives":  # not set yet
+            raise AttributeError(name)
+        try:
+            return self.objectives[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        """Write slots as usual, and any other attribute (an objective or its parent value) into objectives."""
+        if name in CompactSoftBot.__slots__ or name in ["phenotype", "parent_genotype"]:
+            object.__setattr__(self, name, value)
+        else:
+            self.objectives[name] = value
+
+    @property
+    def phenotype(self):
+        if self._phenotype is None:
+            self._phenotype = self.phenotype_class(self.genotype)
+        return self._phenotype
+
+    @phenotype.setter
+    def phenotype(self, phenotype):
+        self._phenotype = phenotype
+
+    @property
+    def parent_genotype(self):
+        if self._parent_genotype is None:
+            return self.genotype
+        return self._parent_genotype()
+
+    @parent_genotype.setter
+    def parent_genotype(self, genotype):
+        self._parent_genotype = None if genotype is self.genotype else weakref.ref(genotype)
+
+    def __deepcopy__(self, memo):
+        """Copy the slots, sharing the weak link to the parent genotype."""
+        cls = self.__class__
+        new = cls.__new__(cls)
+        memo[id(self)] = new
+        for name in self.__slots__:
+            object.__setattr__(new, name, deepcopy(getattr(self, name), memo))
+        return new
+
+    def __getstate__(self):
+        """Pickle the slots, except the link to the parent genotype which is lost."""
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        if state["_parent_genotype"] is not None:
+            state["_parent_genotype"] = _lost_genotype
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+def _random_individual(args):
+    """Create a random individual from its own seed, return it if its phenotype is valid or None otherwise.
+
+    Used by Population.add_random_individuals, in worker processes or in the current one (where the state of the random
+    number generators is restored afterwards).
+
+    """
+    softbot_class, objective_dict, genotype, phenotype, seed = args
+    states = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        ind = softbot_class(-1, objective_dict, genotype, phenotype)
+        return ind if ind.phenotype.is_valid() else None
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+
+
 class Population(object):
     """A population of SoftBots."""
 
-    def __init__(self, objective_dict, genotype, phenotype, pop_size=30):
+    # defaults for populations pickled before these options were introduced
+    sorted_objectives = None
+    softbot_class = SoftBot
+    lineage_parents = None
+    num_workers = None
+    pool = None
+    random_individuals_stats = None
+    novelty_archive = None
+    similarity_cache = None
+
+    def __init__(self, objective_dict, genotype, phenotype, pop_size=30, softbot_class=SoftBot, num_workers=None,
+                 novelty_archive=None):
 
         """Initialize a population of individual SoftBots.
 
@@ -372,9 +632,25 @@ class Population(object):
         pop_size : int
             The target number of individuals to maintain in the population.
 
+        softbot_class : SoftBot or CompactSoftBot
+            The class of the individuals created by the population.
+
+        num_workers : int
+            If not None, random individuals are created in batches by this number of processes, each candidate with its
+            own seed (see add_random_individuals). Otherwise they are created one at a time from the global random
+            number generators. The processes are started on first use and kept until close_pool is called.
+
+        novelty_archive : NoveltyArchive
+            If not None, novelty_based_selection measures novelty against the behaviours stored in this archive.
+
         """
         self.genotype = genotype
         self.phenotype = phenotype
+        self.softbot_class = softbot_class
+        self.num_workers = num_workers
+        self.random_individuals_stats = {"candidates": 0, "accepted": 0}
+        self.novelty_archive = novelty_archive
+        self.similarity_cache = {}  # trajectory similarities by id, see selection.get_trajectory_similarities
         self.pop_size = pop_size
         self.gen = 0
         self.total_evaluations = 0
@@ -383,12 +659,18 @@ class Population(object):
         self.objective_dict = objective_dict
         self.best_fit_so_far = objective_dict[0]["worst_value"]
         self.individuals = []
-        self.lineage_dict = {}
+        self.lineage_parents = np.empty(0, dtype=np.int64)  # parent id of each tracked id, see update_lineages
         self.max_id = 0
         self.non_dominated_size = 0
+        self.sorted_objectives = None  # objective table and pareto levels after the last sort_by_objectives
 
-        while len(self) < pop_size:
-            self.add_random_individual()
+        self.add_random_individuals(pop_size)
+
+    def __getstate__(self):
+        """Leave the pool of worker processes out of checkpoints, it is started again when needed."""
+        state = self.__dict__.copy()
+        state.pop("pool", None)
+        return state
 
     def __iter__(self):
         """Iterate over the individuals. Use the expression 'for n in population'."""
@@ -424,11 +706,11 @@ class Population(object):
         """
         if type(individuals) == list:
             for n in range(len(individuals)):
-                if type(individuals[n]) != SoftBot:
+                if type(individuals[n]) not in [SoftBot, CompactSoftBot]:
                     raise TypeError("Non-SoftBot added to the population")
             self.individuals += individuals
 
-        elif type(individuals) == SoftBot:
+        elif type(individuals) in [SoftBot, CompactSoftBot]:
             self.individuals += [individuals]
 
     def sort(self, key, reverse=False):
@@ -449,11 +731,87 @@ class Population(object):
     def add_random_individual(self):
         valid = False
         while not valid:
-            ind = SoftBot(self.max_id, self.objective_dict, self.genotype, self.phenotype)
-            if ind.phenotype.is_valid():
+            ind = self.softbot_class(self.max_id, self.objective_dict, self.genotype, self.phenotype)
+            valid = ind.phenotype.is_valid()
+            self.record_random_candidates(1, valid)
+            if valid:
                 self.individuals.append(ind)
                 self.max_id += 1
-                valid = True
+
+    def record_random_candidates(self, num_candidates, num_accepted):
+        """Update the acceptance statistics of random individuals."""
+        if self.random_individuals_stats is None:
+            self.random_individuals_stats = {"candidates": 0, "accepted": 0}
+        self.random_individuals_stats["candidates"] += num_candidates
+        self.random_individuals_stats["accepted"] += int(num_accepted)
+
+    def add_random_individuals(self, num_individuals, seed=None):
+        """Add a number of valid random individuals to the population.
+
+        If num_workers is None, individuals are created one at a time (see add_random_individual). Otherwise candidates
+        are created in batches by a pool of num_workers processes. The k-th candidate is created from the k-th seed
+        drawn from a generator seeded with seed, and the first valid candidates are accepted in this order, so the new
+        individuals only depend on seed (not on the number of workers). The size of each batch is estimated from the
+        acceptance rate of the previous candidates.
+
+        Parameters
+        ----------
+        num_individuals : int
+            The number of individuals to add.
+
+        seed : int
+            Seed of the candidates. If None, it is drawn from the global random number generator.
+
+        """
+        if self.num_workers is None:
+            for _ in range(num_individuals):
+                self.add_random_individual()
+            return
+
+        if seed is None:
+            seed = random.getrandbits(31)
+        seeds = np.random.RandomState(seed)
+        pool = self.get_pool()
+
+        new_individuals = []
+        while len(new_individuals) < num_individuals:
+            stats = self.random_individuals_stats or {"candidates": 0, "accepted": 0}
+            acceptance_rate = max(stats["accepted"], 1) / float(max(stats["candidates"], 1))
+            batch_size = int(math.ceil((num_individuals - len(new_individuals)) / acceptance_rate))
+            batch_size = max(self.num_workers, batch_size - batch_size % -self.num_workers)  # fill the workers
+
+            args = [(self.softbot_class, self.objective_dict, self.genotype, self.phenotype, candidate_seed)
+                    for candidate_seed in seeds.randint(2 ** 31 - 1, size=batch_size)]
+            candidates = pool.map(_random_individual, args) if pool is not None else map(_random_individual, args)
+
+            valid = [ind for ind in candidates if ind is not None]
+            self.record_random_candidates(len(candidates), len(valid))
+            new_individuals += valid
+
+        for ind in new_individuals[:num_individuals]:
+            ind.id = self.max_id
+            self.individuals.append(ind)
+            self.max_id += 1
+
+    def get_pool(self):
+        """Return the pool of num_workers processes creating random individuals, started on first use.
+
+        Returns
+        -------
+        pool : multiprocessing.Pool
+            The pool, or None if there is a single worker (candidates are then created in the current process).
+
+        """
+        if self.pool is None and self.num_workers > 1:
+            self.pool = multiprocessing.Pool(self.num_workers)
+        return self.pool
+
+    def close_pool(self):
+        """Stop the worker processes, if any: they are started again by the next add_random_individuals."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def update_ages(self):
         """Increment the age of each individual."""
@@ -462,41 +820,97 @@ class Population(object):
             ind.variation_type = "survived"
 
     def update_lineages(self):
-        """Tracks ancestors of the current population."""
+        """Tracks ancestors of the current population.
+
+        Lineages are stored as a parent-pointer array indexed by id: -1 marks a randomly created individual and -2 an
+        id which is not tracked (not yet seen, or collected). The parent of each new individual is recorded, then the
+        current individuals and their ancestors are marked and the pointers of all the other (dead) ids are cleared.
+
+        Returns
+        -------
+        ancestors_ids : numpy.ndarray
+            The ids of the current individuals and of all their ancestors.
+
+        """
+        if self.lineage_parents is None:  # population pickled with per-id ancestor lists
+            self.lineage_parents = np.empty(0, dtype=np.int64)
+            for child, lineage in self.__dict__.pop("lineage_dict", {}).items():
+                for parent in lineage:
+                    self._record_parent(child, parent)
+                    child = parent
+                self._record_parent(child, -1)
+
         for ind in self:
-            if ind.id not in self.lineage_dict:
-                if ind.parent_id > -1:
-                    # parent already in dictionary
-                    self.lineage_dict[ind.id] = [ind.parent_id] + self.lineage_dict[ind.parent_id]
-                else:
-                    # randomly created ind has no parents
-                    self.lineage_dict[ind.id] = []
-
-        current_ids = [ind.id for ind in self]
-        keys_to_remove = [key for key in self.lineage_dict if key not in current_ids]
-        for key in keys_to_remove:
-            del self.lineage_dict[key]
+            if ind.id >= len(self.lineage_parents) or self.lineage_parents[ind.id] == -2:
+                self._record_parent(ind.id, ind.parent_id)
 
-    def sort_by_objectives(self):
-        """Sorts the population multiple times by each objective, from least important to most important."""
+        # mark: chase the pointers of each individual until an already marked id or the root of the lineage
+        parents = self.lineage_parents
+        marked = np.zeros(len(parents), dtype=bool)
         for ind in self:
-            if math.isnan(ind.fitness):
-                ind.fitness = self.objective_dict[0]["worst_value"]
-                print "FITNESS WAS NAN, RESETTING IT TO:", self.objective_dict[0]["worst_value"]
+            this_id = ind.id
+            while this_id >= 0 and not marked[this_id]:
+                marked[this_id] = True
+                this_id = parents[this_id]
+
+        # sweep: dead branches
+        parents[~marked] = -2
+        return np.flatnonzero(marked)
+
+    def _record_parent(self, ind_id, parent_id):
+        """Set the parent pointer of ind_id, doubling the size of the array if needed."""
+        if ind_id >= len(self.lineage_parents):
+            size = max(2 * len(self.lineage_parents), ind_id + 1, 64)
+            parents = np.empty(size, dtype=np.int64)
+            parents.fill(-2)
+            parents[:len(self.lineage_parents)] = self.lineage_parents
+            self.lineage_parents = parents
+        self.lineage_parents[ind_id] = parent_id
+
+    def get_lineage(self, ind_id):
+        """Return the ids of the ancestors of ind_id, from its parent to the oldest tracked ancestor."""
+        lineage = []
+        parent_id = self.lineage_parents[ind_id] if ind_id < len(self.lineage_parents) else -2
+        while parent_id >= 0:
+            lineage += [int(parent_id)]
+            parent_id = self.lineage_parents[parent_id]
+        return lineage
+
+    def get_lineage_length(self, ind_id):
+        """Return the number of ancestors of ind_id, following the parent pointers."""
+        return len(self.get_lineage(ind_id))
 
-        self.sort(key="id", reverse=True)  # (max) promotes neutral mutation
-        self.sort(key="age", reverse=False)  # (min) protects younger, undeveloped solutions
+    def sort_by_objectives(self):
+        """Sorts the population multiple times by each objective, from least important to most important.
 
+        The order is that of successive stable sorts by id (max), age (min), each objective from the least to the most
+        important, then pareto level (min), computed with a single lexicographic sort of the objective table. If the
+        objectives and the order of the individuals are the same as after the last call, nothing is done.
+
+        """
+        table = self.get_objective_table(parents=False)
+        for n in np.nonzero(table["fitness"] != table["fitness"])[0]:  # NaN
+            self[n].fitness = table["fitness"][n] = self.objective_dict[0]["worst_value"]
+            print "FITNESS WAS NAN, RESETTING IT TO:", self.objective_dict[0]["worst_value"]
+        pareto_levels = np.array([ind.pareto_level for ind in self])
+
+        if self.sorted_objectives is not None and np.array_equal(self.sorted_objectives[0], table) and \
+                np.array_equal(self.sorted_objectives[1], pareto_levels):
+            return
+
+        # np.lexsort sorts by the last key first, each key is the rank of the values, negated to sort from the largest
+        keys = [-np.unique(table["id"], return_inverse=True)[1],  # (max) promotes neutral mutation
+                np.unique(table["age"], return_inverse=True)[1]]  # (min) protects younger, undeveloped solutions
         for rank in reversed(range(len(self.objective_dict))):
             if not self.objective_dict[rank]["logging_only"]:
                 goal = self.objective_dict[rank]
-                self.sort(key=goal["name"], reverse=goal["maximize"])
+                ranks = np.unique(table[goal["name"]], return_inverse=True)[1]
+                keys += [-ranks if goal["maximize"] else ranks]
+        keys += [pareto_levels]  # min
 
-        self.sort(key="pareto_level", reverse=False)  # min
-
-        # print "rank in sort_by_objectives:", [len(i.dominated_by) for i in self]
-        # print "age in sort_by_objectives:", [i.age for i in self]
-        # print "fitness in sort_by_objectives:", [i.fitness for i in self]
+        order = np.lexsort(keys)
+        self.individuals[:] = [self.individuals[n] for n in order]
+        self.sorted_objectives = (table[order], pareto_levels[order])
 
     def dominated_in_multiple_objectives(self, ind1, ind2):
         """Calculate if ind1 is dominated by ind2 according to all objectives in objective_dict.
@@ -514,26 +928,82 @@ class Population(object):
         # return np.any(losses) and not np.any(wins)
         return not np.any(wins)
 
+    def get_objective_table(self, parents=True):
+        """Return the objectives of the individuals as a structured array, whose row n holds those of population[n].
+
+        The fields are id, age, then each objective followed by its parent value ("parent_" + name) if parents is
+        True, each with the NumPy type of its values. The attributes of the individuals are read once, after which the
+        objectives can be compared for the whole population at once.
+
+        """
+        names = ["id", "age"]
+        for rank in range(len(self.objective_dict)):
+            name = self.objective_dict[rank]["name"]
+            fields = [name, "parent_" + name] if parents else [name]
+            names += [field for field in fields if field not in names]
+        return np.rec.fromarrays([np.array([getattr(ind, name) for ind in self]) for name in names], names=names)
+
+    def get_dominance_matrix(self, table=None):
+        """Return the boolean matrix whose element (i, j) is True if individual i is dominated by individual j.
+
+        Individual j dominates individual i if it is better or equal in all objectives (see
+        dominated_in_multiple_objectives). The objectives are compared for all the pairs at once, one objective at a
+        time, from the objective table (see get_objective_table), which is read again if not given.
+
+        """
+        if table is None:
+            table = self.get_objective_table(parents=False)
+        dominated = np.ones((len(self), len(self)), dtype=bool)
+        for rank in reversed(range(len(self.objective_dict))):
+            if not self.objective_dict[rank]["logging_only"]:
+                goal = self.objective_dict[rank]
+                values = table[goal["name"]]
+                with np.errstate(invalid="ignore"):  # NaN wins against nothing, as in dominates()
+                    if goal["maximize"]:
+                        dominated &= ~(values[:, np.newaxis] > values)  # i wins against j
+                    else:
+                        dominated &= ~(values[:, np.newaxis] < values)
+        return dominated
+
+    def get_adjusted_dominance_matrix(self, table=None):
+        """Return the dominance matrix (see get_dominance_matrix) with the rules of calc_dominance applied.
+
+        No individual is dominated by itself, of two tied individuals only the older one is dominated, and individuals
+        with the worst fitness (doing nothing or invalid) are dominated by all the others.
+
+        """
+        if table is None:
+            table = self.get_objective_table(parents=False)
+        ids = table["id"]
+        dominated = self.get_dominance_matrix(table)
+        dominated &= ids[:, np.newaxis] != ids  # not by itself
+        dominated &= ~(dominated.T & (ids[:, np.newaxis] > ids))  # of two tied individuals, the newer one wins
+        invalid = table["fitness"] == self.objective_dict[0]["worst_value"]
+        dominated[invalid] |= ~invalid
+        return dominated
+
     def calc_dominance(self):
-        """Determine which other individuals in the population dominate each individual."""
+        """Determine which other individuals in the population dominate each individual.
+
+        Returns
+        -------
+        dominated : numpy.ndarray
+            The adjusted dominance matrix the dominators are read from (see get_adjusted_dominance_matrix), in the
+            order of the population, which is sorted by id.
+
+        """
 
         self.sort(key="id", reverse=False)  # if tied on all objectives, give preference to newer individual
 
         # clear old calculations of dominance
         self.non_dominated_size = 0
-        for ind in self:
-            ind.dominated_by = []
-            ind.pareto_level = 0
 
-        for ind in self:
-            for other_ind in self:
-                # if (other_ind.fitness >= ind.fitness) and \
-                #         self.dominated_in_multiple_objectives(ind, other_ind) and \
-                #         (ind.id not in other_ind.dominated_by) and \
-                #         (other_ind.id != ind.id):
-                if other_ind.id != ind.id:
-                    if self.dominated_in_multiple_objectives(ind, other_ind) and (ind.id not in other_ind.dominated_by):
-                        ind.dominated_by += [other_ind.id]
+        table = self.get_objective_table(parents=False)
+        ids = table["id"]
+        dominated = self.get_adjusted_dominance_matrix(table)
+
+        for ind, dominated_by in zip(self, dominated):
+            ind.dominated_by = ids[dominated_by].tolist()
 
             if ind.fitness == self.objective_dict[0]["worst_value"]:  # extra penalty for doing nothing or being invalid
                 ind.dominated_by += [ind.id for _ in range(self.pop_size * 2)]
@@ -543,3 +1013,5 @@ class Population(object):
             # update the count of non_dominated individuals
             if ind.pareto_level == 0:
                 self.non_dominated_size += 1
+
+        return dominated
@@ -0,0 +1,69 @@
+import copy
+import random
+import numpy as np
+
+from evosoro.networks import CPPN, CompactCPPN
+from evosoro.softbot import Genotype, Phenotype, express_all
+from evosoro.tools.utils import make_material_tree
+
+
+IND_SIZE = (6, 6, 6)
+
+
+def make_genotype(network, dtype):
+    """Return a genotype with the material tree of basic_evolution.py, mapped from a copy of network."""
+    genotype = Genotype(orig_size_xyz=IND_SIZE, dtype=dtype)
+    genotype.add_network(copy.deepcopy(network))
+
+    genotype.to_phenotype_mapping.add_map(name="material", tag="<Data>", func=make_material_tree,
+                                          dependency_order=["shape", "muscleOrTissue", "muscleType", "tissueType"],
+                                          output_type=int)
+    genotype.to_phenotype_mapping.add_output_dependency(name="shape", dependency_name=None, requirement=None,
+                                                        material_if_true=None, material_if_false="0")
+    genotype.to_phenotype_mapping.add_output_dependency(name="muscleOrTissue", dependency_name="shape",
+                                                        requirement=True, material_if_true=None,
+                                                        material_if_false=None)
+    genotype.to_phenotype_mapping.add_output_dependency(name="tissueType", dependency_name="muscleOrTissue",
+                                                        requirement=False, material_if_true="1", material_if_false="2")
+    genotype.to_phenotype_mapping.add_output_dependency(name="muscleType", dependency_name="muscleOrTissue",
+                                                        requirement=True, material_if_true="3", material_if_false="4")
+    return genotype
+
+
+def make_networks(network_class, num_networks, seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+    return [network_class(output_node_names=["shape", "muscleOrTissue", "muscleType", "tissueType"])
+            for _ in range(num_networks)]
+
+
+def get_material(genotype):
+    return genotype.to_phenotype_mapping["material"]["state"]
+
+
+def test_float32_materials_match_float64():
+    for network_class in [CPPN, CompactCPPN]:
+        for network in make_networks(network_class, 20):
+            material64 = get_material(Phenotype(make_genotype(network, np.float64)).genotype)
+            material32 = get_material(Phenotype(make_genotype(network, np.float32)).genotype)
+            assert np.array_equal(material32, material64)
+
+
+def test_float32_output_states_have_reduced_precision():
+    network = make_networks(CPPN, 1)[0]
+    genotype = Phenotype(make_genotype(network, np.float32)).genotype
+    for name in genotype[0].output_node_names:
+        assert genotype[0].get_output_state(name).dtype == np.float32
+
+
+def test_float32_batched_expression_matches_sequential():
+    networks = make_networks(CPPN, 10, seed=1)
+    sequential = [make_genotype(network, np.float32) for network in networks]
+    batched = [make_genotype(network, np.float32) for network in networks]
+    for genotype in sequential:
+        genotype.express()
+    express_all(batched)
+    for genotype1, genotype2 in zip(sequential, batched):
+        for name in genotype1[0].output_node_names:
+            assert np.array_equal(genotype1[0].get_output_state(name), genotype2[0].get_output_state(name))
+        assert np.array_equal(get_material(genotype1), get_material(genotype2))
@@ -7,6 +7,7 @@ from functools import partial
 
 from evaluation import evaluate_all
 from selection import fit_tournament_selection, pareto_selection, pareto_tournament_selection, novelty_based_selection
+from selection import nsga2_selection
 from mutation import create_new_children, create_new_children_through_cppn_mutation, genome_wide_mutation
 from logging import PrintLog, initialize_folders, make_gen_directories, write_gen_stats
 
@@ -65,7 +66,7 @@ class PopulationBasedOptimizer(Optimizer):
     def run(self, max_hours_runtime=29, max_gens=3000, num_random_individuals=1, num_env_cycles=0,
             directory="tests_data", name="TestRun",
             max_eval_time=60, time_to_try_again=10, checkpoint_every=100, save_vxa_every=100, save_pareto=False,
-            save_nets=False, save_lineages=False, continued_from_checkpoint=False):
+            save_nets=False, save_lineages=False, save_memory_usage=False, continued_from_checkpoint=False):
 
         if self.autosuspended:
             sub.call("rm %s/AUTOSUSPENDED" % directory, shell=True)
@@ -90,7 +91,7 @@ class PopulationBasedOptimizer(Optimizer):
                           self.name, max_eval_time, time_to_try_again, save_lineages)
             self.select(self.pop)  # only produces stats, no selection happening (population not replaced)
             write_gen_stats(self.pop, self.directory, self.name, save_vxa_every, save_pareto, save_nets,
-                            save_lineages=save_lineages)
+                            save_lineages=save_lineages, save_memory_usage=save_memory_usage)
             print_log.message("Saving checkpoint at generation {0}".format(self.pop.gen), timer_name="start")
             self.save_checkpoint(self.directory, self.pop.gen)
 
@@ -111,9 +112,14 @@ class PopulationBasedOptimizer(Optimizer):
             # combine children and parents for selection
             print_log.message("Now creating new population")
             self.pop.append(new_children)
-            for _ in range(self.num_random_inds):
-                print_log.message("Random individual added to population")
-                self.pop.add_random_individual()
+            if self.pop.num_workers is None:
+                for _ in range(self.num_random_inds):
+                    print_log.message("Random individual added to population")
+                    self.pop.add_random_individual()
+            else:
+                self.pop.add_random_individuals(self.num_random_inds)
+                if self.num_random_inds > 0:
+                    print_log.message("%d random individual(s) added to population" % self.num_random_inds)
             print_log.message("New population size is %d" % len(self.pop))
 
             # evaluate fitness
@@ -130,7 +136,7 @@ class PopulationBasedOptimizer(Optimizer):
             # print population to stdout and save all individual data
             print_log.message("Saving statistics")
             write_gen_stats(self.pop, self.directory, self.name, save_vxa_every, save_pareto, save_nets,
-                            save_lineages=save_lineages)
+                            save_lineages=save_lineages, save_memory_usage=save_memory_usage)
 
             # replace population with selection
             self.pop.individuals = new_population
@@ -147,6 +153,8 @@ class PopulationBasedOptimizer(Optimizer):
                 sub.call("touch {0}/AUTOSUSPENDED && rm {0}/RUNNING".format(self.directory), shell=True)
                 break
 
+        self.pop.close_pool()
+
         if not self.autosuspended:  # print end of run stats
             print_log.message("Finished {0} generations".format(self.pop.gen))
             print_log.message("DONE!", timer_name="start")
@@ -174,6 +182,12 @@ class ParetoOptimization(PopulationBasedOptimizer):
                                           pareto_selection, create_new_children_through_cppn_mutation)
 
 
+class NSGA2Optimization(PopulationBasedOptimizer):
+    def __init__(self, sim, env, pop):
+        PopulationBasedOptimizer.__init__(self, sim, env, pop,
+                                          nsga2_selection, create_new_children_through_cppn_mutation)
+
+
 class ParetoTournamentOptimization(PopulationBasedOptimizer):
     def __init__(self, sim, env, pop):
         PopulationBasedOptimizer.__init__(self, sim, env, pop, pareto_tournament_selection,
@@ -9,7 +9,7 @@ from evosoro.tools.utils import natural_sort
 
 def continue_from_checkpoint(directory="tests_data", additional_gens=0, max_hours_runtime=29,
                              max_eval_time=60, time_to_try_again=10, checkpoint_every=1, save_vxa_every=1,
-                             save_pareto=False, save_nets=False, save_lineages=False):
+                             save_pareto=False, save_nets=False, save_lineages=False, save_memory_usage=False):
 
     if os.path.isfile("./" + directory + "/RUNNING"):
         sub.call("touch {}/DUPLICATE".format(directory), shell=True)
@@ -42,4 +42,5 @@ def continue_from_checkpoint(directory="tests_data", additional_gens=0, max_hour
             optimizer.run(continued_from_checkpoint=True, max_hours_runtime=max_hours_runtime, max_gens=max_gens,
                           max_eval_time=max_eval_time, time_to_try_again=time_to_try_again,
                           checkpoint_every=checkpoint_every, save_vxa_every=save_vxa_every,
-                          save_lineages=save_lineages, save_nets=save_nets, save_pareto=save_pareto)
+                          save_lineages=save_lineages, save_nets=save_nets, save_pareto=save_pareto,
+                          save_memory_usage=save_memory_usage)
@@ -167,7 +167,11 @@ def evaluate_all(sim, env, pop, print_log, save_vxa_every, run_directory, run_na
 
                     objective_values_dict = read_voxlyze_results(pop, print_log, ind_filename)
                     if env.novelty_based:
-                        centroids = read_voxelyze_centroids(pop, print_log, ind_filename)
+                        trace_filename = run_directory + "/tempFiles/cmTrace--id_%05i.bin" % this_id
+                        centroids = read_voxelyze_centroids(pop, print_log, ind_filename, trace_filename)
+                        trajectory = from_centroids_to_trajectory(centroids)
+                        del centroids  # release the memory map before removing the trace file
+                        sub.call("rm -f " + trace_filename, shell=True)
 
                     print_log.message("{0} fit = {1} ({2} / {3})".format(ls_check, objective_values_dict[0],
                                                                          num_evals_finished,
@@ -183,7 +187,7 @@ def evaluate_all(sim, env, pop, print_log, save_vxa_every, run_directory, run_na
                                 if objective_values_dict[rank] is not None:
                                     setattr(ind, details["name"], objective_values_dict[rank])
                                     if env.novelty_based:
-                                        setattr(ind, "trajectory", from_centroids_to_trajectory(centroids))
+                                        setattr(ind, "trajectory", trajectory)
                                 else:
                                     # for network in ind.genotype:
                                     #     for name in network.output_node_names:
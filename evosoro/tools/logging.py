@@ -1,11 +1,15 @@
+import os
 import copy
+import cPickle
 import time
 import sys
 import networkx as nx
 import subprocess as sub
 import numpy as np
 from glob import glob
+from collections import OrderedDict
 
+from evosoro.networks import CompactCPPN, INPUT_GRIDS
 from evosoro.tools.utils import find_between
 
 
@@ -125,15 +129,24 @@ def record_individuals_data(pop, path, num_inds_to_save=None, print_to_terminal=
         # network outputs
         # for name in output_names:
         #     details = ind.genotype.to_phenotype_mapping[name]
+        # the parent genotype of a CompactSoftBot may be gone, its columns are then nan
+        parent_genotype = ind.parent_genotype if ind.parent_genotype is not None else [None] * len(ind.genotype)
         for name, details in ind.genotype.to_phenotype_mapping.items():
             if details["logging_stats"] is not None:
-                for network, parent_network in zip(ind.genotype, ind.parent_genotype):
+                for network, parent_network in zip(ind.genotype, parent_genotype):
                     if name in network.output_node_names:
                         if not network.direct_encoding:
-                            state = network.graph.node[name]["state"]
-                            parent_state = parent_network.graph.node[name]["state"]
+                            state = network.get_output_state(name)
                         else:
                             state = network.values
+                        if parent_network is None:
+                            objectives_string += "nan\t\t"
+                            for stat in details["logging_stats"]:
+                                objectives_string += "{}\t\t".format(stat(state)) + "nan\t\t" + "nan\t\t"
+                            continue
+                        if not network.direct_encoding:
+                            parent_state = parent_network.get_output_state(name)
+                        else:
                             parent_state = parent_network.values
                         diff = state - parent_state
                         any_changes = np.any(state != parent_state)
@@ -229,7 +242,8 @@ def make_gen_directories(population, run_directory, save_vxa_every, save_network
 
 
 def write_gen_stats(population, run_directory, run_name, save_vxa_every, save_pareto, save_networks,
-                    save_all_individual_data=True, num_inds_to_save=None, save_lineages=False):
+                    save_all_individual_data=True, num_inds_to_save=None, save_lineages=False,
+                    save_memory_usage=False):
 
     write_champ_file(population, run_directory)
 
@@ -246,6 +260,9 @@ def write_gen_stats(population, run_directory, run_name, save_vxa_every, save_pa
     if population.gen % save_vxa_every == 0 and save_vxa_every > 0 and save_pareto:
         write_pareto_front(population, run_directory, run_name)
 
+    if save_memory_usage:
+        write_memory_usage(population, run_directory)
+
     sub.call("rm " + run_directory + "/voxelyzeFiles/* 2>/dev/null", shell=True)  # clear the voxelyzeFiles folder
 
 
@@ -254,6 +271,17 @@ def write_champ_file(population, run_directory):
     record_individuals_data(population, champ_file, 1)
 
 
+def write_memory_usage(population, run_directory):
+    """Append the mean memory usage of the individuals (see memory_report) to memoryUsage.txt."""
+    report = memory_report(population)
+    path = run_directory + "/memoryUsage.txt"
+    if not os.path.isfile(path):
+        with open(path, 'w') as _file:
+            _file.write("\t\t".join(["gen"] + report.keys()) + "\n")
+    with open(path, 'a') as _file:
+        _file.write("\t\t".join([str(population.gen)] + ["%d" % nbytes for nbytes in report.values()]) + "\n")
+
+
 def write_gen_individuals_data(population, run_directory, num_inds_to_save):
     gen_file = run_directory + "/allIndividualsData/Gen_%04i.txt" % population.gen
     make_header(population, gen_file)
@@ -261,14 +289,8 @@ def write_gen_individuals_data(population, run_directory, num_inds_to_save):
 
 
 def remove_old_lineages(population, run_directory):
-    population.update_lineages()
-    print " Length of best lineage: {}".format(len(population.lineage_dict[population[0].id]))
-
-    ancestors_ids = [ind.id for ind in population]  # include current generation
-    for child, lineage in population.lineage_dict.items():
-        for parent in lineage:
-            if parent not in ancestors_ids:
-                ancestors_ids += [parent]
+    ancestors_ids = set(population.update_lineages().tolist())  # includes the current generation
+    print " Length of best lineage: {}".format(population.get_lineage_length(population[0].id))
 
     for vxa in glob(run_directory + "/ancestors/*"):
         this_id = int(find_between(vxa, "--id_", ".vxa"))
@@ -295,10 +317,83 @@ def write_networks(population, run_directory):
         clone = copy.deepcopy(individual)
         net_idx = 0
         for network in clone.genotype:
-            for name in network.graph.nodes():
-                network.graph.node[name]["state"] = ""  # remove state information to reduce file size
-                network.graph.node[name]["evaluated"] = 0
-            nx.write_gml(network.graph, run_directory +
+            graph = network.graph  # built on each access for a CompactCPPN
+            for name in graph.nodes():
+                graph.node[name]["state"] = ""  # remove state information to reduce file size
+                graph.node[name]["evaluated"] = 0
+            nx.write_gml(graph, run_directory +
                          "/network_gml/Gen_%04i/network--%02i--fit_%.08f--id_%05i" %
                          (population.gen, net_idx, clone.fitness, clone.id) + ".txt")
             net_idx += 1
+
+
+def get_memory_usage(individual):
+    """Return the bytes held by an individual, by kind of state, and the size of its pickle.
+
+    Each array is counted once, in the first kind holding it, and a view counts as the whole array it is taken from.
+    The input grids, shared by all the CPPNs of a size, are left out.
+
+    Parameters
+    ----------
+    individual : SoftBot
+        The individual to measure.
+
+    Returns
+    -------
+    usage : OrderedDict
+        Bytes of the output states, the hidden node states and the states cached by the compiled CPPNs of the
+        genotype, of the phenotype states (current and before mutation), of the arrays of the parent genotype not
+        shared with the genotype, and of the pickled individual.
+
+    """
+    counted = set(id(state) for grids in INPUT_GRIDS.values() for state in grids.values())
+    usage = OrderedDict((kind, 0) for kind in ["output_states", "hidden_states", "compiled_cache", "phenotype_states",
+                                               "parent_genotype", "pickled"])
+
+    def count(kind, state):
+        while isinstance(state, np.ndarray) and isinstance(state.base, np.ndarray):
+            state = state.base
+        if isinstance(state, np.ndarray) and id(state) not in counted:
+            counted.add(id(state))
+            usage[kind] += state.nbytes
+
+    for kind, state in _genotype_arrays(individual.genotype):
+        count(kind, state)
+    for name, details in individual.genotype.to_phenotype_mapping.items():
+        count("phenotype_states", details["state"])
+        count("phenotype_states", details["old_state"])
+    for details in individual.genotype.to_phenotype_mapping.dependencies.values():
+        count("phenotype_states", details["state"])
+    if individual.parent_genotype is not None:
+        for kind, state in _genotype_arrays(individual.parent_genotype):
+            count("parent_genotype", state)
+
+    usage["pickled"] = len(cPickle.dumps(individual, cPickle.HIGHEST_PROTOCOL))
+    return usage
+
+
+def _genotype_arrays(genotype):
+    """Yield the (kind, array) pairs of the states held by the networks of a genotype, see get_memory_usage."""
+    for network in genotype:
+        if network.direct_encoding:
+            yield "output_states", network.values
+            continue
+        if isinstance(network, CompactCPPN):
+            for state in network.output_states.values():
+                yield "output_states", state
+        else:
+            for name in network.graph.nodes():
+                kind = "output_states" if name in network.output_node_names else "hidden_states"
+                yield kind, network.graph.node[name].get("state")
+        if network.compiled is not None and network.compiled.states is not None:
+            for state in network.compiled.states:
+                yield "compiled_cache", state
+
+
+def memory_report(population):
+    """Return the mean memory usage of the individuals of a population, in bytes by kind (see get_memory_usage)."""
+    report = OrderedDict()
+    for individual in population:
+        for kind, nbytes in get_memory_usage(individual).items():
+            report[kind] = report.get(kind, 0) + nbytes / float(len(population))
+    return report
@@ -4,6 +4,9 @@ import math
 import numpy as np
 import random
 
+from evosoro.softbot import express_all
+
+
 def create_new_children_through_cppn_mutation(pop, print_log, new_children=None, mutate_network_probs=None,
                                          max_mutation_attempts=1500):
     """Create copies, with modification, of existing individuals in the population.
@@ -37,8 +40,9 @@ def create_new_children_through_cppn_mutation(pop, print_log, new_children=None,
     random.shuffle(pop.individuals)
 
     while len(new_children) < pop.pop_size:
+        searches = []
         for ind in pop:
-            clone = copy.deepcopy(ind)
+            clone = _copy_individual(ind)
 
             if mutate_network_probs is None:
                 required = 0
@@ -70,73 +74,59 @@ def create_new_children_through_cppn_mutation(pop, print_log, new_children=None,
             for name, details in clone.genotype.to_phenotype_mapping.items():
                 details["old_state"] = copy.deepcopy(details["state"])
 
-            for selected_net_idx in selected_networks:
-                mutation_counter = 0
+            searches += [{"clone": clone, "networks": selected_networks, "attempts": 0}]
+
+        # look for a successful mutation of the selected networks of every clone at the same time: each round tries
+        # one candidate per clone, and all the candidates are expressed together
+        active = [search for search in searches if len(search["networks"]) > 0]
+        while len(active) > 0:
+            candidates = []
+            for search in active:
+                search["attempts"] += 1
+                candidates += [_mutate_candidate(search["clone"], search["networks"][0])]
+
+            express_all([candidate.genotype for candidate in candidates])
+
+            for search, candidate in zip(active, candidates):
+                selected_net_idx = search["networks"][0]
                 done = False
-                while not done:
-                    mutation_counter += 1
-                    candidate = copy.deepcopy(clone)
-
-                    # perform mutation(s)
-                    for _ in range(candidate.genotype[selected_net_idx].num_consecutive_mutations):
-                        if not clone.genotype[selected_net_idx].direct_encoding:
-                            # using CPPNs
-                            mut_func_args = inspect.getargspec(candidate.genotype[selected_net_idx].mutate)
-                            mut_func_args = [0 for _ in range(1, len(mut_func_args.args))]
-                            choice = random.choice(range(len(mut_func_args)))
-                            mut_func_args[choice] = 1
-                            variation_type, variation_degree = candidate.genotype[selected_net_idx].mutate(*mut_func_args)
-                        else:
-                            # direct encoding with possibility of evolving mutation rate
-                            # TODO: enable cppn mutation rate evolution
-                            rate = None
-                            for net in clone.genotype:
-                                if "mutation_rate" in net.output_node_names:
-                                    rate = net.values  # evolved mutation rates, one for each voxel
-                            if "mutation_rate" not in candidate.genotype[selected_net_idx].output_node_names:
-                                # use evolved mutation rates
-                                variation_type, variation_degree = candidate.genotype[selected_net_idx].mutate(rate)
-                            else:
-                                # this is the mutation rate itself (use predefined meta-mutation rate)
-                                variation_type, variation_degree = candidate.genotype[selected_net_idx].mutate()
-
-                    if variation_degree != "":
-                        candidate.variation_type = "{0}({1})".format(variation_type, variation_degree)
-                    else:
-                        candidate.variation_type = str(variation_type)
-                    candidate.genotype.express()
-
-                    if candidate.genotype[selected_net_idx].allow_neutral_mutations:
-                        done = True
-                        clone = copy.deepcopy(candidate)  # SAM: ensures change is made to every net
-                        break
-                    else:
-                        for name, details in candidate.genotype.to_phenotype_mapping.items():
-                            new = details["state"]
-                            old = details["old_state"]
-                            changes = np.array(new != old, dtype=np.bool)
-                            if np.any(changes) and candidate.phenotype.is_valid():
-                                done = True
-                                clone = copy.deepcopy(candidate)  # SAM: ensures change is made to every net
-                                break
-                        # for name, details in candidate.genotype.to_phenotype_mapping.items():
-                        #     if np.sum( details["old_state"] != details["state"] ) and candidate.phenotype.is_valid():
-                        #         done = True
-                        #         break
-
-                    if mutation_counter > max_mutation_attempts:
-                        print_log.message("Couldn't find a successful mutation in {} attempts! "
-                                          "Skipping this network.".format(max_mutation_attempts))
-                        num_edges = len(clone.genotype[selected_net_idx].graph.edges())
-                        num_nodes = len(clone.genotype[selected_net_idx].graph.nodes())
-                        print_log.message("num edges: {0}; num nodes {1}".format(num_edges, num_nodes))
-                        break
-
-                # end while
-
-                if not clone.genotype[selected_net_idx].direct_encoding:
-                    for output_node in clone.genotype[selected_net_idx].output_node_names:
-                        clone.genotype[selected_net_idx].graph.node[output_node]["old_state"] = ""
+
+                if candidate.genotype[selected_net_idx].allow_neutral_mutations:
+                    done = True
+                    search["clone"] = _copy_individual(candidate)  # SAM: ensures change is made to every net
+                else:
+                    for name, details in candidate.genotype.to_phenotype_mapping.items():
+                        new = details["state"]
+                        old = details["old_state"]
+                        changes = np.array(new != old, dtype=np.bool)
+                        if np.any(changes) and candidate.phenotype.is_valid():
+                            done = True
+                            search["clone"] = _copy_individual(candidate)  # SAM: ensures change is made to every net
+                            break
+
+                if not done and search["attempts"] > max_mutation_attempts:
+                    print_log.message("Couldn't find a successful mutation in {} attempts! "
+                                      "Skipping this network.".format(max_mutation_attempts))
+                    num_edges = len(search["clone"].genotype[selected_net_idx].graph.edges())
+                    num_nodes = len(search["clone"].genotype[selected_net_idx].graph.nodes())
+                    print_log.message("num edges: {0}; num nodes {1}".format(num_edges, num_nodes))
+                    done = True
+
+                if done:
+                    clone = search["clone"]
+                    if not clone.genotype[selected_net_idx].direct_encoding:
+                        clone.genotype[selected_net_idx].reset_old_states()
+                    search["networks"].pop(0)
+                    search["attempts"] = 0
+
+            active = [search for search in active if len(search["networks"]) > 0]
+
+        for search in searches:
+            clone = search["clone"]
+
+            # the states before mutation are only needed by the search
+            for name, details in clone.genotype.to_phenotype_mapping.items():
+                details["old_state"] = None
 
             # reset all objectives we calculate in VoxCad to unevaluated values
             for rank, goal in pop.objective_dict.items():
@@ -150,6 +140,51 @@ def create_new_children_through_cppn_mutation(pop, print_log, new_children=None,
     return new_children
 
 
+def _copy_individual(ind):
+    """Deep copy an individual, sharing what the copy only reads: the parent genotype and the states before mutation."""
+    memo = {}
+    if ind.parent_genotype is not ind.genotype:
+        memo[id(ind.parent_genotype)] = ind.parent_genotype
+    for name, details in ind.genotype.to_phenotype_mapping.items():
+        if details["old_state"] is not None:
+            memo[id(details["old_state"])] = details["old_state"]
+    return copy.deepcopy(ind, memo)
+
+
+def _mutate_candidate(clone, selected_net_idx):
+    """Return a copy of clone with its selected network mutated, not expressed yet."""
+    candidate = _copy_individual(clone)
+
+    # perform mutation(s)
+    for _ in range(candidate.genotype[selected_net_idx].num_consecutive_mutations):
+        if not clone.genotype[selected_net_idx].direct_encoding:
+            # using CPPNs
+            mut_func_args = inspect.getargspec(candidate.genotype[selected_net_idx].mutate)
+            mut_func_args = [0 for _ in range(1, len(mut_func_args.args))]
+            choice = random.choice(range(len(mut_func_args)))
+            mut_func_args[choice] = 1
+            variation_type, variation_degree = candidate.genotype[selected_net_idx].mutate(*mut_func_args)
+        else:
+            # direct encoding with possibility of evolving mutation rate
+            # TODO: enable cppn mutation rate evolution
+            rate = None
+            for net in clone.genotype:
+                if "mutation_rate" in net.output_node_names:
+                    rate = net.values  # evolved mutation rates, one for each voxel
+            if "mutation_rate" not in candidate.genotype[selected_net_idx].output_node_names:
+                # use evolved mutation rates
+                variation_type, variation_degree = candidate.genotype[selected_net_idx].mutate(rate)
+            else:
+                # this is the mutation rate itself (use predefined meta-mutation rate)
+                variation_type, variation_degree = candidate.genotype[selected_net_idx].mutate()
+
+    if variation_degree != "":
+        candidate.variation_type = "{0}({1})".format(variation_type, variation_degree)
+    else:
+        candidate.variation_type = str(variation_type)
+    return candidate
+
+
 def mutate_controllers(pop, children, crossover_rate=0.4):
     # controllers crossover
     random.shuffle(children)
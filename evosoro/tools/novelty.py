@@ -0,0 +1,252 @@
+import math
+import random
+import numpy as np
+from scipy import spatial
+
+
+def trajectory_descriptor(trajectory, num_points=5, dims=(0, 1)):
+    """Turn a trajectory of displacements (see from_centroids_to_trajectory) into a fixed-length behaviour descriptor.
+
+    Parameters
+    ----------
+    trajectory : numpy.ndarray
+        A (T, 4) array of displacements (x, y, z, time).
+
+    num_points : int
+        The number of positions, evenly spaced in time, which are sampled along the trajectory.
+
+    dims : tuple
+        The coordinates of each position in the descriptor.
+
+    Returns
+    -------
+    descriptor : numpy.ndarray
+        The sampled positions, flattened (None if the trajectory is empty, i.e. the phenotype is invalid).
+
+    """
+    if len(trajectory) == 0:
+        return None
+    positions = np.cumsum(np.asarray(trajectory, dtype=float)[:, list(dims)], axis=0)
+    samples = np.round(np.linspace(0, len(positions) - 1, num_points)).astype(int)
+    return positions[samples].ravel()
+
+
+class NoveltyArchive(object):
+    """An archive of the behaviour descriptors of past individuals, indexed by a KD-tree for nearest neighbour queries.
+
+    The tree is static, so new descriptors are kept in a buffer which is scanned linearly, and removed ones are only
+    flagged as dead. The tree is rebuilt (dropping the dead descriptors) when the buffer and the dead entries outnumber
+    the square root of the size of the archive, so queries stay sublinear and rebuilds are amortized over insertions.
+
+    """
+
+    def __init__(self, k=15, capacity=None, insertion="threshold", threshold=0.0, probability=0.1,
+                 descriptor_func=trajectory_descriptor, min_rebuild_size=16):
+
+        """
+        Parameters
+        ----------
+        k : int
+            The number of nearest neighbours whose mean distance is the novelty of a behaviour.
+
+        capacity : int
+            The maximum number of descriptors in the archive. When it is full the oldest descriptor is removed.
+            If None the archive grows without limits.
+
+        insertion : str
+            Which new individuals are added to the archive:
+            "all" - every individual;
+            "threshold" - the individuals whose novelty is at least threshold;
+            "random" - each individual with the given probability.
+
+        threshold : float
+            The novelty threshold of the "threshold" insertion policy.
+
+        probability : float
+            The insertion probability of the "random" insertion policy.
+
+        descriptor_func : func
+            Computes the behaviour descriptor (a fixed-length array, or None) of an individual from its trajectory.
+
+        min_rebuild_size : int
+            The smallest number of buffered and dead descriptors which triggers a rebuild of the tree.
+
+        """
+        if insertion not in ["all", "threshold", "random"]:
+            raise ValueError("Unknown insertion policy: {}".format(insertion))
+
+        self.k = k
+        self.capacity = capacity
+        self.insertion = insertion
+        self.threshold = threshold
+        self.probability = probability
+        self.descriptor_func = descriptor_func
+        self.min_rebuild_size = min_rebuild_size
+
+        self.descriptors = None  # rows of descriptors, allocated when the first one is added
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.num_rows = 0  # rows in use, the first tree_size of which are indexed by the tree
+        self.tree_size = 0
+        self.num_dead = 0
+        self.oldest = 0  # row of the oldest descriptor still alive
+        self.last_id = -1  # individuals with higher ids have not been considered for insertion yet
+        self.tree = None
+
+    def __len__(self):
+        """Return the number of descriptors in the archive. Use the expression 'len(archive)'."""
+        return self.num_rows - self.num_dead
+
+    def __getstate__(self):
+        """The tree is not pickled, it is rebuilt by the first query."""
+        state = self.__dict__.copy()
+        state["tree"] = None
+        state["tree_size"] = 0
+        return state
+
+    def add(self, descriptor, ind_id):
+        """Add the descriptor of individual ind_id, removing the oldest one if the archive is full."""
+        if self.capacity is not None:
+            while len(self) >= self.capacity > 0:
+                self.remove_oldest()
+
+        if self.descriptors is None:
+            self.descriptors = np.empty((0, len(descriptor)), dtype=float)
+        if self.num_rows == len(self.descriptors):
+            size = max(2 * self.num_rows, 64)
+            self.descriptors = np.resize(self.descriptors, (size, self.descriptors.shape[1]))
+            self.ids = np.resize(self.ids, size)
+            self.alive = np.resize(self.alive, size)
+
+        self.descriptors[self.num_rows] = descriptor
+        self.ids[self.num_rows] = ind_id
+        self.alive[self.num_rows] = True
+        self.num_rows += 1
+
+    def remove_oldest(self):
+        """Flag the oldest descriptor as dead."""
+        while not self.alive[self.oldest]:
+            self.oldest += 1
+        self.alive[self.oldest] = False
+        self.num_dead += 1
+
+    def rebuild(self):
+        """Drop the dead descriptors and index all the others with a new tree."""
+        if self.num_dead > 0:
+            keep = np.flatnonzero(self.alive[:self.num_rows])
+            self.num_rows = len(keep)
+            self.descriptors[:self.num_rows] = self.descriptors[keep]
+            self.ids[:self.num_rows] = self.ids[keep]
+            self.alive[:self.num_rows] = True
+            self.num_dead = 0
+            self.oldest = 0
+
+        self.tree = spatial.cKDTree(self.descriptors[:self.num_rows]) if self.num_rows > 0 else None
+        self.tree_size = self.num_rows
+
+    def query(self, descriptors, k, exclude_ids=()):
+        """Return the distances of the k nearest descriptors in the archive.
+
+        Parameters
+        ----------
+        descriptors : numpy.ndarray
+            A (n, d) array of behaviour descriptors.
+
+        k : int
+            The number of neighbours.
+
+        exclude_ids : list
+            Ids of individuals whose descriptors are ignored.
+
+        Returns
+        -------
+        distances : numpy.ndarray
+            A (n, k) array of sorted distances, padded with inf if there are less than k descriptors.
+
+        """
+        descriptors = np.atleast_2d(np.asarray(descriptors, dtype=float))
+        distances = np.empty((len(descriptors), 0))
+
+        buffered = self.num_rows - self.tree_size
+        if self.tree is None or buffered + self.num_dead > max(self.min_rebuild_size, math.sqrt(len(self))):
+            self.rebuild()
+        exclude_ids = np.asarray(list(exclude_ids), dtype=np.int64)
+
+        if self.tree is not None:
+            # enough neighbours to skip the dead and excluded descriptors indexed by the tree
+            num_neighbours = min(k + self.num_dead + len(exclude_ids), self.tree_size)
+            tree_distances, rows = self.tree.query(descriptors, num_neighbours)
+            tree_distances = tree_distances.reshape(len(descriptors), num_neighbours)
+            rows = rows.reshape(len(descriptors), num_neighbours)
+            ignored = ~self.alive[rows] | np.in1d(self.ids[rows], exclude_ids).reshape(rows.shape)
+            distances = np.where(ignored, np.inf, tree_distances)
+
+        if self.num_rows > self.tree_size:
+            rows = np.arange(self.tree_size, self.num_rows)
+            rows = rows[self.alive[rows] & ~np.in1d(self.ids[rows], exclude_ids)]
+            distances = np.hstack((distances, spatial.distance.cdist(descriptors, self.descriptors[rows])))
+
+        if distances.shape[1] < k:
+            distances = np.hstack((distances, np.full((len(descriptors), k - distances.shape[1]), np.inf)))
+        return np.sort(distances, axis=1)[:, :k]
+
+    def get_novelty(self, population):
+        """Compute the novelty of each individual in the population.
+
+        The novelty is the mean distance to the k nearest behaviours among the archive and the rest of the population
+        (the descriptors of individuals in both are only counted once). Individuals with no descriptor get -inf.
+
+        Parameters
+        ----------
+        population : Population
+            The individuals, with their trajectories.
+
+        Returns
+        -------
+        novelty : numpy.ndarray
+            The novelty of each individual.
+
+        """
+        novelty = np.full(len(population), -np.inf)
+        descriptors = [self.descriptor_func(ind.trajectory) for ind in population]
+        rows = [n for n, descriptor in enumerate(descriptors) if descriptor is not None]
+        if len(rows) == 0:
+            return novelty
+
+        descriptors = np.array([descriptors[n] for n in rows], dtype=float)
+        ids = [population[n].id for n in rows]
+
+        population_distances = spatial.distance.cdist(descriptors, descriptors)
+        np.fill_diagonal(population_distances, np.inf)
+        distances = np.hstack((self.query(descriptors, self.k, exclude_ids=ids), population_distances))
+        distances = np.sort(distances, axis=1)[:, :self.k]
+
+        finite = np.isfinite(distances)
+        novelty[rows] = np.where(finite, distances, 0).sum(axis=1) / np.maximum(finite.sum(axis=1), 1)
+        return novelty
+
+    def update(self, population, novelty):
+        """Add the descriptors of the individuals not considered yet, according to the insertion policy.
+
+        Parameters
+        ----------
+        population : Population
+            The individuals, with their trajectories.
+
+        novelty : numpy.ndarray
+            The novelty of each individual (see get_novelty).
+
+        """
+        last_id = self.last_id
+        for ind, ind_novelty in zip(population, novelty):
+            if ind.id <= last_id:
+                continue
+            self.last_id = max(self.last_id, ind.id)
+
+            if np.isneginf(ind_novelty):  # no behaviour
+                continue
+            if self.insertion == "threshold" and ind_novelty < self.threshold:
+                continue
+            if self.insertion == "random" and random.random() >= self.probability:
+                continue
+            self.add(self.descriptor_func(ind.trajectory), ind.id)
@@ -39,7 +39,7 @@ def read_voxlyze_results(population, print_log, filename="softbotsOutput.xml"):
     return results
 
 
-def read_voxelyze_centroids(population, print_log, filename="softbotsOutput.xml"):
+def read_voxelyze_centroids(population, print_log, filename="softbotsOutput.xml", trace_filename=None):
     i = 0
     max_attempts = 60
     file_size = 0
@@ -59,6 +59,10 @@ def read_voxelyze_centroids(population, print_log, filename="softbotsOutput.xml"
         print_log.message("ERROR: Cannot find a non-empty fitness file in %d attempts: abort" % max_attempts)
         exit(1)
 
+    if trace_filename is not None and os.path.isfile(trace_filename):
+        return read_voxelyze_trace_file(trace_filename)
+
+    # fall back on the xml trace (e.g. voxelyze builds which don't write the binary trace)
     centroids = []
     root = ET.parse(filename).getroot()
     for trace in root.findall('CMTrace/TraceStep'):
@@ -66,9 +70,25 @@ def read_voxelyze_centroids(population, print_log, filename="softbotsOutput.xml"
         x = float(trace.find('TraceX').text)
         y = float(trace.find('TraceY').text)
         z = float(trace.find('TraceZ').text)
-        centroids.append(np.array([x, y, z, t]))
+        centroids.append([x, y, z, t])
+
+    return np.array(centroids, dtype=float).reshape(-1, 4)
+
+
+def read_voxelyze_trace_file(filename):
+    """Memory-map the binary center of mass trace written by voxelyze.
 
-    return centroids
+    The file is a packed stream of float32 records (x, y, z, time), one per trace step.
+
+    Returns
+    -------
+    centroids : numpy.ndarray
+        A read-only (T, 4) view of the trace.
+
+    """
+    if os.stat(filename).st_size == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    return np.memmap(filename, dtype=np.float32, mode="r").reshape(-1, 4)
 
 
 def write_voxelyze_file(sim, env, individual, run_directory, run_name):
@@ -167,6 +187,8 @@ def write_voxelyze_file(sim, env, individual, run_directory, run_name):
         <WriteFitnessFile>1</WriteFitnessFile>\n\
         <FitnessFileName>" + run_directory + "/fitnessFiles/softbotsOutput--id_%05i.xml" % individual.id +
         "</FitnessFileName>\n\
+        <TraceFileName>" + (run_directory + "/tempFiles/cmTrace--id_%05i.bin" % individual.id
+                            if env.novelty_based else "") + "</TraceFileName>\n\
         <QhullTmpFile>" + run_directory + "/tempFiles/qhullInput--id_%05i.txt" % individual.id + "</QhullTmpFile>\n\
         <CurvaturesTmpFile>" + run_directory + "/tempFiles/curvatures--id_%05i.txt" % individual.id +
         "</CurvaturesTmpFile>\n\
@@ -435,22 +457,23 @@ def write_voxelyze_file(sim, env, individual, run_directory, run_name):
                 voxelyze_file.write(param_tag + str(param) + "</" + param_tag[1:] + "\n")
 
         if details["env_kws"] is None:
+            # reduced precision float states are written with as many digits as their type holds
+            output_type = details["output_type"]
+            if output_type is float and details["state"].dtype != np.float64:
+                output_type = details["state"].dtype.type
+
             # write the output state matrix to file
             if not env.obstacles:
                 for z in range(individual.genotype.orig_size_xyz[2]):
-                    voxelyze_file.write("<Layer><![CDATA[")
-                    for y in range(individual.genotype.orig_size_xyz[1]):
-                        for x in range(individual.genotype.orig_size_xyz[0]):
-
-                            state = details["output_type"](details["state"][x, y, z])
-                            # for n, network in enumerate(individual.genotype):
-                            #     if name in network.output_node_names:
-                            #         state = individual.genotype[n].graph.node[name]["state"][x, y, z]
+                    # the states of the layer, x varying fastest
+                    layer = [str(output_type(state)) for state in details["state"][:, :, z].T.ravel()]
 
-                            voxelyze_file.write(str(state))
-                            if details["tag"] != "<Data>":  # TODO more dynamic
-                                voxelyze_file.write(", ")
-                            string_for_md5 += str(state)
+                    voxelyze_file.write("<Layer><![CDATA[")
+                    if details["tag"] != "<Data>":  # TODO more dynamic
+                        voxelyze_file.write("".join(state + ", " for state in layer))
+                    else:
+                        voxelyze_file.write("".join(layer))
+                    string_for_md5 += "".join(layer)
 
                     voxelyze_file.write("]]></Layer>\n")
             else:
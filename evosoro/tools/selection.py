@@ -1,5 +1,4 @@
 import random
-import math
 import copy
 import numpy as np
 from utils import AMSS
@@ -33,18 +32,61 @@ def fit_tournament_selection(population, tournament_size=2):
     return population.individuals
 
 
-def pareto_selection(population):
+def log_rank_sample(num_items, num_samples, rng=np.random):
+    """Sample indices of a ranked list without replacement, favoring the best ranks on a logarithmic scale.
+
+    The first (best) index is always taken. Each other index i is then drawn with a probability proportional to
+    log(i + 1) - log(i), i.e. as if a uniform number between 0 and log(num_items) was drawn repeatedly and the index
+    of its bucket [log(i), log(i + 1)) taken if it was not taken yet. Instead of rejecting the draws which hit a taken
+    index, each index gets an exponential arrival time with its weight as rate, and the first ones to arrive are taken
+    in a single pass (successive sampling, with the same distribution).
+
+    Parameters
+    ----------
+    num_items : int
+        The length of the ranked list.
+
+    num_samples : int
+        The number of indices to sample (at most num_items).
+
+    rng : numpy.random.RandomState
+        The random number generator, for reproducibility (by default the global one).
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        The sampled indices, in the order in which they were drawn.
+
+    """
+    if num_samples <= 0:
+        return np.empty(0, dtype=int)
+    ranks = np.arange(1, num_items)
+    arrivals = -np.log(1.0 - rng.random_sample(len(ranks))) / np.log1p(1.0 / ranks)
+
+    num_drawn = min(num_samples, num_items) - 1
+    first = np.arange(len(ranks))
+    if 0 < num_drawn < len(ranks):
+        first = np.argpartition(arrivals, num_drawn - 1)
+    first = first[:num_drawn]
+    return np.concatenate(([0], ranks[first[np.argsort(arrivals[first], kind="mergesort")]])).astype(int)
+
+
+def pareto_selection(population, rng=np.random):
     """Return a list of selected individuals from the population.
 
     All individuals in the population are ranked by their level, i.e. the number of solutions they are dominated by.
     Individuals are added to a list based on their ranking, best to worst, until the list size reaches the target
-    population size (population.pop_size).
+    population size (population.pop_size). Within the level which does not fit entirely, individuals are sampled by
+    their rank on a logarithmic scale (see log_rank_sample).
 
     Parameters
     ----------
     population : Population
         This provides the individuals for selection.
 
+    rng : numpy.random.RandomState
+        The random number generator used to sample within a level, for reproducibility (by default the global one).
+
     Returns
     -------
     new_population : list
@@ -62,38 +104,27 @@ def pareto_selection(population):
     # divide individuals into "pareto levels":
     # pareto level 0: individuals that are not dominated,
     # pareto level 1: individuals dominated one other individual, etc.
-    done = False
-    pareto_level = 0
-    while not done:
-        this_level = []
+    pareto_levels = {}
+    for ind in population:
+        pareto_levels.setdefault(len(ind.dominated_by), []).append(ind)
+
+    # add best individuals to the new population.
+    # add the best pareto levels first until it is not possible to fit them in the new_population
+    for pareto_level in sorted(pareto_levels):
+        this_level = pareto_levels[pareto_level]
         size_left = population.pop_size - len(new_population)
-        for ind in population:
-            if len(ind.dominated_by) == pareto_level:
-                this_level += [ind]
-
-        # add best individuals to the new population.
-        # add the best pareto levels first until it is not possible to fit them in the new_population
-        if len(this_level) > 0:
-            if size_left >= len(this_level):  # if whole pareto level can fit, add it
-                new_population += this_level
-
-            else:  # otherwise, select by sorted ranking within the level
-                new_population += [this_level[0]]
-                while len(new_population) < population.pop_size:
-                    random_num = random.random()
-                    log_level_length = math.log(len(this_level))
-                    for i in range(1, len(this_level)):
-                        if math.log(i) / log_level_length <= random_num < math.log(i + 1) / log_level_length and \
-                                        this_level[i] not in new_population:
-                            new_population += [this_level[i]]
-                            continue
-
-        pareto_level += 1
+        if size_left >= len(this_level):  # if whole pareto level can fit, add it
+            new_population += this_level
+
+        else:  # otherwise, select by sorted ranking within the level
+            new_population += [this_level[i] for i in log_rank_sample(len(this_level), size_left, rng)]
+
         if len(new_population) == population.pop_size:
-            done = True
+            break
 
+    selected = set(id(ind) for ind in new_population)
     for ind in population:
-        if ind in new_population:
+        if id(ind) in selected:
             ind.selected = 1
         else:
             ind.selected = 0
@@ -101,6 +132,99 @@ def pareto_selection(population):
     return new_population
 
 
+def non_dominated_fronts(dominated):
+    """Split individuals into successive non-dominated fronts (fast non-dominated sorting).
+
+    Parameters
+    ----------
+    dominated : numpy.ndarray
+        Boolean matrix whose element (i, j) is True if individual i is dominated by individual j.
+
+    Returns
+    -------
+    fronts : list
+        The indices of the individuals of each front, best first.
+
+    """
+    num_dominators = dominated.sum(axis=1)
+    remaining = np.ones(len(dominated), dtype=bool)
+    fronts = []
+    while remaining.any():
+        front = np.flatnonzero(remaining & (num_dominators == 0))
+        if len(front) == 0:  # dominance cycle (can't happen with a strict order), keep the rest together
+            front = np.flatnonzero(remaining)
+        fronts += [front]
+        remaining[front] = False
+        num_dominators -= dominated[:, front].sum(axis=1)
+    return fronts
+
+
+def crowding_distance(table, objective_dict):
+    """Return the NSGA-II crowding distance of each row of an objective table (see Population.get_objective_table).
+
+    For each objective, the individuals are sorted by value: those at the boundaries get an infinite distance, and the
+    others the gap between their two neighbours, normalized by the range of the objective.
+
+    """
+    distance = np.zeros(len(table), dtype=float)
+    for rank in range(len(objective_dict)):
+        if not objective_dict[rank]["logging_only"]:
+            values = np.asarray(table[objective_dict[rank]["name"]], dtype=float)
+            order = np.argsort(values, kind="mergesort")
+            value_range = values[order[-1]] - values[order[0]]
+            distance[order[[0, -1]]] = np.inf
+            if len(values) > 2 and 0 < value_range < np.inf:
+                distance[order[1:-1]] += (values[order[2:]] - values[order[:-2]]) / value_range
+    return distance
+
+
+def nsga2_selection(population):
+    """Return a list of selected individuals from the population, as in NSGA-II.
+
+    Individuals are split into non-dominated fronts (with the dominance of Population.calc_dominance: ties are won by
+    the newer individual, and individuals with the worst fitness are dominated by all the others). Whole fronts are
+    selected, best first, until the next one does not fit in the target population size (population.pop_size). The
+    rest is taken from that front by decreasing crowding distance, which favors individuals in sparse regions of the
+    objective space.
+
+    Parameters
+    ----------
+    population : Population
+        This provides the individuals for selection.
+
+    Returns
+    -------
+    new_population : list
+        A list of selected individuals.
+
+    """
+    # (re)compute dominance for each individual, and sort the population as in pareto_selection (for logging)
+    dominated = population.calc_dominance()
+    rows = dict((id(ind), n) for n, ind in enumerate(population))  # row of each individual in the dominance matrix
+    population.sort_by_objectives()
+
+    order = [rows[id(ind)] for ind in population]
+    dominated = dominated[np.ix_(order, order)]
+    table = population.get_objective_table(parents=False)
+
+    new_population = []
+    for front in non_dominated_fronts(dominated):
+        size_left = population.pop_size - len(new_population)
+        if size_left <= 0:
+            break
+        if len(front) > size_left:
+            distance = crowding_distance(table[front], population.objective_dict)
+            front = front[np.argsort(-distance, kind="mergesort")[:size_left]]
+        new_population += [population[n] for n in front]
+
+    for ind in population:
+        ind.selected = 0
+    for ind in new_population:
+        ind.selected = 1
+
+    return new_population
+
+
 def pareto_tournament_selection(population):
     """Reduce the population pairwise.
 
@@ -124,18 +248,23 @@ def pareto_tournament_selection(population):
     random.shuffle(population.individuals)
     print "The nondominated size is", population.non_dominated_size
 
+    dominated = population.get_dominance_matrix()
+    rows = range(len(population))  # row of each remaining individual in the dominance matrix
+
     while len(population) > population.pop_size and len(population) > population.non_dominated_size:
 
         inds = random.sample(range(len(population)), 2)
         ind0 = population[inds[0]]
         ind1 = population[inds[1]]
 
-        if population.dominated_in_multiple_objectives(ind0, ind1):
+        if dominated[rows[inds[0]], rows[inds[1]]]:
             print "(fit) {0} dominated by {1}".format(ind0.fitness, ind1.fitness)
             population.pop(inds[0])
-        elif population.dominated_in_multiple_objectives(ind1, ind0):
+            rows.pop(inds[0])
+        elif dominated[rows[inds[1]], rows[inds[0]]]:
             print "(fit) {1} dominated by {0}".format(ind0.fitness, ind1.fitness)
             population.pop(inds[1])
+            rows.pop(inds[1])
         # else:
         #     population.pop(random.choice(inds))
 
@@ -146,6 +275,9 @@ def pareto_tournament_selection(population):
 
 def novelty_based_selection(population):
     """
+    If the population has a novelty archive, see archive_novelty_selection. Otherwise the novelty of an individual is
+    its summed trajectory similarity to the population, and the least similar individuals are selected.
+
     Parameters
     ----------
     population : Population
@@ -157,21 +289,25 @@ def novelty_based_selection(population):
         A list of selected individuals.
 
     """
+    if population.novelty_archive is not None:
+        return archive_novelty_selection(population, population.novelty_archive)
+
     if len(population) <= population.pop_size:
         return population
     else:
         similarities = np.zeros(len(population), dtype=float)
+        similarity_matrix = get_trajectory_similarities(population)
 
         for i in range(len(population)):
-            if not population[i].trajectory:
+            if len(population[i].trajectory) == 0:
                 # the phenotype of the individual is invalid
                 similarities[i] = 10000000.0
                 continue
             for j in range(i, len(population)):
-                if not population[j].trajectory:
+                if len(population[j].trajectory) == 0:
                     # the phenotype of the individual is invalid
                     continue
-                sim = AMSS(population[i].trajectory, population[j].trajectory).trajectory_similarity()
+                sim = similarity_matrix[i, j]
                 similarities[i] += sim
                 if i != j:
                     similarities[j] += sim
@@ -187,4 +323,110 @@ def novelty_based_selection(population):
         for ind in new_population:
             ind.selected = 1
 
+        # forget the similarities of the individuals which did not survive
+        survivors = set(ind.id for ind in new_population)
+        for ind_id in population.similarity_cache.keys():
+            if ind_id not in survivors:
+                forget_trajectory_similarities(population.similarity_cache, ind_id)
+
         return new_population
+
+
+def _trajectory_similarity(trajectories):
+    """AMSS similarity of a pair of trajectories (a module function, so that it can be sent to worker processes)."""
+    return AMSS(*trajectories).trajectory_similarity()
+
+
+def forget_trajectory_similarities(similarity_cache, ind_id):
+    """Remove all the cached similarities of individual ind_id."""
+    entry = similarity_cache.pop(ind_id, None)
+    if entry is not None:
+        for other_id in entry[1]:
+            if other_id != ind_id:
+                similarity_cache[other_id][1].pop(ind_id, None)
+
+
+def get_trajectory_similarities(population):
+    """Return the AMSS similarities of every pair of individuals with a trajectory.
+
+    Similarities are kept across generations in population.similarity_cache, which maps the id of an individual to its
+    trajectory and to a dict of its similarities by id. An entry is dropped when the trajectory of the individual is
+    replaced (e.g. by a new evaluation), so only the pairs involving new trajectories are computed, in the pool of
+    worker processes of the population if there is one (see Population.get_pool).
+
+    Parameters
+    ----------
+    population : Population
+        This provides the individuals and the cache.
+
+    Returns
+    -------
+    similarity_matrix : numpy.ndarray
+        The similarity of each pair of individuals, in the order of the population (zero if either has no trajectory).
+
+    """
+    if population.similarity_cache is None:
+        population.similarity_cache = {}
+    cache = population.similarity_cache
+
+    inds = [ind for ind in population if len(ind.trajectory) > 0]
+    for ind in inds:
+        if ind.id in cache and cache[ind.id][0] is not ind.trajectory:
+            forget_trajectory_similarities(cache, ind.id)
+        if ind.id not in cache:
+            cache[ind.id] = [ind.trajectory, {}]
+
+    missing = [(ind_i, ind_j) for n, ind_i in enumerate(inds) for ind_j in inds[n:]
+               if ind_j.id not in cache[ind_i.id][1]]
+    if len(missing) > 0:
+        args = [(ind_i.trajectory, ind_j.trajectory) for ind_i, ind_j in missing]
+        pool = population.get_pool() if population.num_workers is not None else None
+        sims = pool.map(_trajectory_similarity, args) if pool is not None else map(_trajectory_similarity, args)
+
+        for (ind_i, ind_j), sim in zip(missing, sims):
+            cache[ind_i.id][1][ind_j.id] = cache[ind_j.id][1][ind_i.id] = sim
+
+    rows = dict((ind.id, n) for n, ind in enumerate(population))
+    similarity_matrix = np.zeros((len(population), len(population)), dtype=float)
+    for ind in inds:
+        for other_id, sim in cache[ind.id][1].items():
+            if other_id in rows:
+                similarity_matrix[rows[ind.id], rows[other_id]] = sim
+    return similarity_matrix
+
+
+def archive_novelty_selection(population, archive):
+    """Return the most novel individuals, with novelty measured against an archive of past behaviours.
+
+    The novelty of each individual is its mean distance to the k nearest behaviours in the archive and the population
+    (see NoveltyArchive.get_novelty), then the new individuals are considered for insertion in the archive.
+
+    Parameters
+    ----------
+    population : Population
+        This provides the individuals for selection.
+
+    archive : NoveltyArchive
+        The behaviours of past individuals.
+
+    Returns
+    -------
+    new_population : list
+        A list of selected individuals.
+
+    """
+    novelty = archive.get_novelty(population)
+    for ind, ind_novelty in zip(population, novelty):
+        ind.novelty = ind_novelty
+    archive.update(population, novelty)
+
+    if len(population) <= population.pop_size:
+        return population
+
+    indices = np.argsort(-novelty, kind="mergesort")[:population.pop_size]
+    new_population = [population[i] for i in indices]
+
+    for ind in new_population:
+        ind.selected = 1
+
+    return new_population
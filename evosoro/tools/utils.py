@@ -4,7 +4,6 @@ import re
 import scipy.ndimage as ndimage
 import math
 from scipy import spatial
-from matplotlib import pyplot as plt
 
 
 def identity(x):
@@ -148,19 +147,31 @@ def make_material_tree(this_softbot, *args, **kwargs):
     if material["dependency_order"] is not None:
         for dependency_name in material["dependency_order"]:
             for network in this_softbot:
-                if dependency_name in network.graph.nodes():
-                    mapping.dependencies[dependency_name]["state"] = \
-                        network.graph.node[dependency_name]["state"] > 0
+                if dependency_name in network.output_node_names:
+                    mapping.dependencies[dependency_name]["state"] = network.get_output_state(dependency_name) > 0
 
     if material["dependency_order"] is not None:
-        for dependency_name in reversed(material["dependency_order"]):
-            if mapping.dependencies[dependency_name]["material_if_true"] is not None:
-                material["state"][mapping.get_dependency(dependency_name, True)] = \
-                    mapping.dependencies[dependency_name]["material_if_true"]
-
-            if mapping.dependencies[dependency_name]["material_if_false"] is not None:
-                material["state"][mapping.get_dependency(dependency_name, False)] = \
-                    mapping.dependencies[dependency_name]["material_if_false"]
+        names, materials, assigned = mapping.get_dependency_table(material["dependency_order"],
+                                                                  material["state"].dtype)
+        states = [mapping.dependencies[name]["state"] for name in names]
+        if all(isinstance(state, np.ndarray) and state.dtype == bool and state.shape == material["state"].shape
+               for state in states):
+            # index of the combination of output states of each voxel in the compiled table
+            index = np.zeros(material["state"].shape, dtype=np.intp)
+            for bit, state in enumerate(states):
+                index |= state.astype(np.intp) << bit
+            np.copyto(material["state"], materials[index], where=assigned[index])
+
+        else:  # some outputs are missing, assign the materials one dependency at a time
+            memo = {}
+            for dependency_name in reversed(material["dependency_order"]):
+                if mapping.dependencies[dependency_name]["material_if_true"] is not None:
+                    material["state"][mapping.get_dependency(dependency_name, True, memo)] = \
+                        mapping.dependencies[dependency_name]["material_if_true"]
+
+                if mapping.dependencies[dependency_name]["material_if_false"] is not None:
+                    material["state"][mapping.get_dependency(dependency_name, False, memo)] = \
+                        mapping.dependencies[dependency_name]["material_if_false"]
 
     return make_one_shape_only(material["state"]) * material["state"]
 
@@ -174,21 +185,21 @@ def make_material_tree_single_muscle_patches(this_softbot, *args, **kwargs):
     #     if details["dependency_order"] is not None:
     for dependency_name in material["dependency_order"]:
         for network in this_softbot:
-            if dependency_name in network.graph.nodes():
-                mapping.dependencies[dependency_name]["state"] = \
-                    network.graph.node[dependency_name]["state"] > 0
+            if dependency_name in network.output_node_names:
+                mapping.dependencies[dependency_name]["state"] = network.get_output_state(dependency_name) > 0
 
     # for name, details in mapping.items():
     #     if details["dependency_order"] is not None:
+    memo = {}
     for dependency_name in reversed(material["dependency_order"]):
         if mapping.dependencies[dependency_name]["material_if_true"] is not None:
-            tmpState = mapping.get_dependency(dependency_name, True)
+            tmpState = mapping.get_dependency(dependency_name, True, memo)
             if dependency_name == "muscleType":
                 tmpState = make_one_shape_only(tmpState)
             material["state"][tmpState] = mapping.dependencies[dependency_name]["material_if_true"]
 
         if mapping.dependencies[dependency_name]["material_if_false"] is not None:
-            tmpState = mapping.get_dependency(dependency_name, False)
+            tmpState = mapping.get_dependency(dependency_name, False, memo)
             if dependency_name == "muscleType":
                 tmpState = make_one_shape_only(tmpState)
                 material["state"][ndimage.morphology.binary_dilation(tmpState)] = "1"
@@ -224,49 +235,82 @@ def make_one_shape_only(output_state, mask=None):
     if mask is None:
         def mask(u): return np.greater(u, 0)
 
-    # print output_state
-    # sys.exit(0)
-
+    presence = np.asarray(mask(output_state), dtype=bool)
     one_shape = np.zeros(output_state.shape, dtype=np.int32)
 
-    if np.sum(mask(output_state)) < 2:
-        one_shape[np.where(mask(output_state))] = 1
+    if np.sum(presence) < 2:
+        one_shape[presence] = 1
         return one_shape
 
-    else:
-        not_yet_checked = []
-        for x in range(output_state.shape[0]):
-            for y in range(output_state.shape[1]):
-                for z in range(output_state.shape[2]):
-                    not_yet_checked.append((x, y, z))
-
-        largest_shape = []
-        queue_to_check = []
-        while len(not_yet_checked) > len(largest_shape):
-            queue_to_check.append(not_yet_checked.pop(0))
-            this_shape = []
-            if mask(output_state[queue_to_check[0]]):
-                this_shape.append(queue_to_check[0])
-
-            while len(queue_to_check) > 0:
-                this_voxel = queue_to_check.pop(0)
-                x = this_voxel[0]
-                y = this_voxel[1]
-                z = this_voxel[2]
-                for neighbor in [(x+1, y, z), (x-1, y, z), (x, y+1, z), (x, y-1, z), (x, y, z+1), (x, y, z-1)]:
-                    if neighbor in not_yet_checked:
-                        not_yet_checked.remove(neighbor)
-                        if mask(output_state[neighbor]):
-                            queue_to_check.append(neighbor)
-                            this_shape.append(neighbor)
-
-            if len(this_shape) > len(largest_shape):
-                largest_shape = this_shape
-
-        for loc in largest_shape:
-            one_shape[loc] = 1
-
-        return one_shape
+    # Shapes are grown from each voxel not yet checked, in (x, y, z) order: a full voxel grows its face-connected
+    # component, an empty one grows the components next to it (merging them), and the empty voxels next to a grown voxel
+    # are checked as well. This is done a whole component at a time rather than voxel by voxel.
+    labels, num_components = ndimage.label(presence, structure=ndimage.generate_binary_structure(3, 1))
+    labels = labels.ravel()
+    presence = presence.ravel()
+    voxel_index = np.arange(presence.size).reshape(output_state.shape)
+
+    # the voxels of each component, and the empty voxels next to them
+    component_voxels = _group_by_label(np.arange(presence.size), labels, num_components)
+    neighbor_labels, empty_neighbors = [], []
+    for axis in range(3):
+        for start, stop in [(slice(0, -1), slice(1, None)), (slice(1, None), slice(0, -1))]:
+            voxels = voxel_index[tuple(start if a == axis else slice(None) for a in range(3))].ravel()
+            neighbors = voxel_index[tuple(stop if a == axis else slice(None) for a in range(3))].ravel()
+            keep = presence[voxels] & ~presence[neighbors]
+            neighbor_labels += [labels[voxels[keep]]]
+            empty_neighbors += [neighbors[keep]]
+    borders = np.concatenate(neighbor_labels).astype(np.int64) * presence.size + np.concatenate(empty_neighbors)
+    borders = np.unique(borders)
+    component_borders = _group_by_label(borders % presence.size, borders // presence.size, num_components)
+
+    size_x, size_y, size_z = output_state.shape
+    checked = np.zeros(presence.size, dtype=bool)
+    num_not_checked = presence.size
+    largest_shape, largest_size = [], 0
+    for voxel in range(presence.size):
+        if num_not_checked <= largest_size:
+            break
+        if checked[voxel]:
+            continue
+
+        if presence[voxel]:
+            shape_labels = [labels[voxel]]
+        else:
+            checked[voxel] = True
+            num_not_checked -= 1
+            shape_labels = []
+            x, y, z = voxel // (size_y * size_z), voxel // size_z % size_y, voxel % size_z
+            for in_bounds, neighbor in [(x + 1 < size_x, voxel + size_y * size_z), (x > 0, voxel - size_y * size_z),
+                                        (y + 1 < size_y, voxel + size_z), (y > 0, voxel - size_z),
+                                        (z + 1 < size_z, voxel + 1), (z > 0, voxel - 1)]:
+                if in_bounds and not checked[neighbor]:
+                    checked[neighbor] = True
+                    num_not_checked -= 1
+                    if presence[neighbor] and labels[neighbor] not in shape_labels:
+                        shape_labels += [labels[neighbor]]
+
+        shape_size = 0
+        for label in shape_labels:
+            border = component_borders[label]
+            num_not_checked -= np.sum(~checked[component_voxels[label]]) + np.sum(~checked[border])
+            checked[component_voxels[label]] = True
+            checked[border] = True
+            shape_size += len(component_voxels[label])
+
+        if shape_size > largest_size:
+            largest_shape, largest_size = shape_labels, shape_size
+
+    for label in largest_shape:
+        one_shape.ravel()[component_voxels[label]] = 1
+
+    return one_shape
+
+
+def _group_by_label(values, labels, num_labels):
+    """Split values into one (possibly empty) array per label, from 0 to num_labels."""
+    order = np.argsort(labels, kind="mergesort")
+    return np.split(values[order], np.cumsum(np.bincount(labels, minlength=num_labels + 1))[:-1])
 
 
 def count_neighbors(output_state, mask=None):
@@ -314,42 +358,21 @@ def angle2D_between(c_1, c_2):
     return angle
 
 def from_centroids_to_trajectory(centroids):
-    x = [e[0] for e in centroids]
-    y = [e[1] for e in centroids]
-    plt.plot(x, y, 'bo')
+    """Turn a (T, 4) center of mass trace (x, y, z, time) into a contiguous (T-1, 4) array of displacements.
 
-    #print("before translation: ", centroids)
-    #for i in range(len(centroids) - 1, -1, -1):
-    #    centroids[i][:2] -= centroids[0][:2]
+    The trace is first rotated so that its first step points along the x axis. The input is never modified (it may be
+    a read-only memory map of the trace file).
 
-    #x = [e[0] for e in centroids]
-    #y = [e[1] for e in centroids]
-    #plt.plot(x, y, 'g^')
+    """
+    centroids = np.array(centroids, dtype=float)
 
     # apply rotation transformation
     theta = angle2D_between(centroids[0][:2], centroids[1][:2])
     cos, sin = np.cos(theta), np.sin(theta)
     rot_mat = np.array(((cos, sin), (-sin, cos)))
+    centroids[:, :2] = np.dot(centroids[:, :2], rot_mat.T)
 
-    for i in range(0, len(centroids)):
-        mat_mul = np.matmul(rot_mat, centroids[i][:2])
-        centroids[i][:2] = mat_mul
-
-    #print("after rotation: ", centroids)
-    #print()
-
-    #x = [e[0] for e in centroids]
-    #y = [e[1] for e in centroids]
-    #plt.plot(x, y, 'r+')
-    #plt.axis([-0.05, 0.05, -0.05, 0.05])
-    #plt.show()
-    #plt.close()
-
-    trajectory = []
-    for i in range(1, len(centroids)):
-        trajectory.append(centroids[i] - centroids[i-1])
-
-    return trajectory
+    return np.ascontiguousarray(np.diff(centroids, axis=0))
 
 
 class AMSS:
@@ -398,31 +421,49 @@ class AMSS:
             self.sim_mat[idx_1, idx_2] = sim
             return sim
 
+    def similarity_matrix(self):
+        """Fill sim_mat with the similarity of every pair of vectors at once (same formulas as similarity)."""
+        v1 = np.asarray(self.v1, dtype=float).reshape(len(self.v1), -1)
+        v2 = np.asarray(self.v2, dtype=float).reshape(len(self.v2), -1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            v1_u = v1 / np.sqrt(np.sum(v1 * v1, axis=1))[:, None]
+            v2_u = v2 / np.sqrt(np.sum(v2 * v2, axis=1))[:, None]
+            angle = np.arccos(np.clip(np.dot(v1_u, v2_u.T), -1.0, 1.0))
+
+            # 1 - cosine distance, which scipy computes from the averages of the products
+            uv = np.mean(v1[:, None, :] * v2[None, :, :], axis=2)
+            uu = np.mean(np.square(v1), axis=1)[:, None]
+            vv = np.mean(np.square(v2), axis=1)[None, :]
+            cosine = 1 - (1.0 - uv / np.sqrt(uu * vv))
+
+        self.sim_mat = np.where(angle <= math.pi / 2.0, cosine, 0.0)
+        return self.sim_mat
+
     def trajectory_similarity_core(self, idx_1, idx_2):
         # reference paper: https://link.springer.com/content/pdf/10.1007%2Fs10044-011-0262-6.pdf
-        amss_sim = 0.0
-
-        if idx_1 >= 0 and idx_2 >= 0:
-            sim = self.mat_similarity(idx_1, idx_2)
+        # The similarity of the sub-trajectories ending at (i, j) is the best of three alignments, which extend those
+        # ending at (i-1, j-1), (i-2, j-1) and (i-1, j-2). All of them lie in the two previous rows, so the scores are
+        # computed bottom-up one row at a time, in O(len(v1) * len(v2)).
+        if idx_1 < 0 or idx_2 < 0:
+            return 0.0
 
-            sim_0 = 2 * sim
-            sim_2 = sim_1 = sim
+        sim_mat = self.similarity_matrix()[:idx_1 + 1, :idx_2 + 1]
+        # scores of the two previous rows, with two leading zero columns for the alignments starting before j = 0
+        amss = np.zeros((3, idx_2 + 3))
 
-            if idx_1 >= 1:
-                sim_1 += 2 * self.mat_similarity(idx_1 - 1, idx_2)
-            if idx_2 >= 1:
-                sim_2 += 2 * self.mat_similarity(idx_1, idx_2 - 1)
+        for i in range(idx_1 + 1):
+            sim = sim_mat[i]
+            above = sim_mat[i - 1] if i >= 1 else np.zeros_like(sim)
+            left = np.concatenate(([0.0], sim[:-1]))
 
-            if idx_1 >= 1 and idx_2 >= 1:
-                sim_0 += self.trajectory_similarity_core(idx_1 - 1, idx_2 - 1)
-                if idx_1 >= 2:
-                    sim_1 += self.trajectory_similarity_core(idx_1 - 2, idx_2 - 1)
-                if idx_2 >= 2:
-                    sim_2 += self.trajectory_similarity_core(idx_1 - 1, idx_2 - 2)
+            sim_0 = 2 * sim + amss[(i - 1) % 3, 1:-1]
+            sim_1 = sim + 2 * above + amss[(i - 2) % 3, 1:-1]
+            sim_2 = sim + 2 * left + amss[(i - 1) % 3, :-2]
 
-            amss_sim = max(sim_0, sim_1, sim_2)
+            amss[i % 3] = 0.0
+            amss[i % 3, 2:] = np.maximum(np.maximum(sim_0, sim_1), sim_2)
 
-        return amss_sim
+        return amss[idx_1 % 3, -1]
 
     def trajectory_similarity(self):
         return self.trajectory_similarity_core(len(self.v1) - 1, len(self.v2) - 1)